@@ -3,6 +3,8 @@
 import access
 import util
 import ranker
+import jobs
+import comparison_log
 import gluon.contrib.simplejson as simplejson
 from datetime import datetime
 import datetime as dates
@@ -289,6 +291,7 @@ def review():
 	subm_id_to_nickname_str = simplejson.dumps(subm_id_to_nickname)
         comparison_id = db.comparison.insert(
 	    venue_id=t.venue_id, ordering=ordering, grades=grades, new_item=new_comparison_item,
+	    ordering_packed=comparison_log.pack_ordering(ordering),
 	    submission_nicknames=subm_id_to_nickname_str) 
         # Marks the task as done.
         t.update_record(completed_date=datetime.utcnow(), is_completed=True, comments=form.vars.comments)
@@ -308,11 +311,10 @@ def review():
 	    has_rated = util.list_append_unique(has_rated, venue.id)
             props.update_record(venues_has_rated = has_rated)
 
-        # TODO(luca): put it in a queue of things that need processing.
         # All updates done.
-        # Calling ranker.py directly.
-        ranker.process_comparison(db, t.venue_id, auth.user.email,
-                                  ordering[::-1], t.submission_id)
+        # The comparison is processed by the ranker later, see
+        # cron/process_comparisons.py.
+        ranker.enqueue_comparison(db, t.venue_id, comparison_id)
         db.commit()
 	session.flash = T('The review has been submitted.')
 	redirect(URL('rating', 'task_index'))
@@ -563,6 +565,7 @@ def edit_ordering():
         last_comparison.update_record(is_valid=False)
         new_comparison_id = db.comparison.insert(
             venue_id=venue.id, ordering=new_ordering, grades=new_grades,
+            ordering_packed=comparison_log.pack_ordering(new_ordering),
             submission_nicknames=subm_id_to_nickname_str,
 	    new_item=last_comparison.new_item)
         # Mark that user has revised the comparison.
@@ -575,11 +578,10 @@ def edit_ordering():
         has_re_reviewed.append(venue.id)
         props.update_record(venues_has_re_reviewed = has_re_reviewed)
 
-        # TODO(luca): put it in a queue of things that need processing.
         # All updates done.
-        # Calling ranker.py directly.
-        ranker.process_comparison(db, venue.id, auth.user.email,
-                                  new_ordering[::-1], last_comparison.new_item)
+        # The comparison is processed by the ranker later, see
+        # cron/process_comparisons.py.
+        ranker.enqueue_comparison(db, venue.id, new_comparison_id)
         db.commit()
         session.flash = T('The review has been submitted.')
         redirect(URL('rating', 'edit_reviews', args=[venue.id]))
@@ -616,12 +618,10 @@ def recompute_ranks():
         {T('Cancel'): URL('venues', 'view_venue', args=[c.id])})
     if confirmation_form.accepted:
         # Rerun ranking algorithm.
-        # TODO(michael): essentially we need to fork a separate process
 	# TODO(luca,michael): ask whether to rerun twice.
-        ranker.rerun_processing_comparisons(db, c.id, alpha_annealing=0.5, run_twice=True)
-        db.commit()
-        session.flash = T('The submission ranking has been recomputed.')
-        redirect(URL('venues', 'view_venue', args=[c.id]))
+        submit_ranking_job(c, 'recompute_ranks',
+                           URL('venues', 'view_venue', args=[c.id]),
+                           alpha_annealing=0.5, run_twice=True)
     return dict(venue_form=venue_form, confirmation_form=confirmation_form)
 
 @auth.requires_login()
@@ -636,22 +636,22 @@ def run_rep_sys_research():
         {T('Cancel'): URL('venues', 'view_venue', args=[c.id])})
     if confirmation_form.accepted:
         if rep_sys_type == 1:
-            # Run without reputation system
-            ranker.rank_without_rep_sys(db, c.id, alpha_annealing=0.5)
+            # Run without reputation system (see ranker.rank_without_rep_sys).
+            params = dict(alpha_annealing=0.5, num_of_iterations=1,
+                          last_compar_param=None)
         elif rep_sys_type == 2:
             # Run reputation system on all comparisons in chronological
             # order one time.
-            ranker.run_reputation_system(db, c.id, alpha_annealing=0.5,
-                                         last_compar_param=None)
+            params = dict(alpha_annealing=0.5, last_compar_param=None)
         elif rep_sys_type == 3:
             # Run reputation system with small alpha on latest comparisons.
-            ranker.run_reputation_system(db, c.id, num_of_iterations=4)
+            params = dict(num_of_iterations=4)
         else:
             # Run the latest reputation system.
-            ranker.run_reputation_system(db, c.id, num_of_iterations=4)
-        db.commit()
-        session.flash = T('The computation of reviewer contribution, submission quality, and final grade is complete.')
-        redirect(URL('venues', 'view_venue_research', args=[c.id]))
+            params = dict(num_of_iterations=4)
+        submit_ranking_job(c, 'run_reputation_system',
+                           URL('venues', 'view_venue_research', args=[c.id]),
+                           **params)
     # Description of reputation system.
     if rep_sys_type == 1:
         description = T("Ranking without reputation system. All comparisons are used in chronological order.")
@@ -675,10 +675,8 @@ def evaluate_reviewers():
     confirmation_form = FORM.confirm(T('Evaluate'),
         {T('Cancel'): URL('venues', 'view_venue', args=[c.id])})
     if confirmation_form.accepted:
-        ranker.evaluate_contributors(db, c.id)
-        db.commit()
-        session.flash = T('The evaluation of reviewers has been performed.')
-        redirect(URL('venues', 'view_venue', args=[c.id]))
+        submit_ranking_job(c, 'evaluate_contributors',
+                           URL('venues', 'view_venue', args=[c.id]))
     return dict(venue_form=venue_form, confirmation_form=confirmation_form)
 
 
@@ -703,10 +701,8 @@ def compute_final_grades():
     confirmation_form = FORM.confirm(T('Compute grades'),
         {T('Cancel'): URL('venues', 'view_venue', args=[c.id])})
     if confirmation_form.accepted:
-        ranker.compute_final_grades(db, c.id)
-        db.commit()
-        session.flash = T('The final grades have been computed.')
-        redirect(URL('venues', 'view_venue', args=[c.id]))
+        submit_ranking_job(c, 'compute_final_grades',
+                           URL('venues', 'view_venue', args=[c.id]))
     return dict(venue_form=venue_form, confirmation_form=confirmation_form)
 
 
@@ -720,10 +716,50 @@ def run_rep_system():
     confirmation_form = FORM.confirm(T('Run'),
         {T('Cancel'): URL('venues', 'view_venue', args=[c.id])})
     if confirmation_form.accepted:
-        num_of_iterations = 4
-        ranker.run_reputation_system(db, c.id,
-                                     num_of_iterations=num_of_iterations)
-        db.commit()
-        session.flash = T('The computation of reviewer contribution, submission quality, and final grade is complete.')
-        redirect(URL('venues', 'view_venue', args=[c.id]))
+        num_of_iterations = ranker.REP_SYS_MAX_ITERATIONS
+        # Runs after the first one only process the new comparisons, unless
+        # some old comparison was invalidated.
+        submit_ranking_job(c, 'run_reputation_system',
+                           URL('venues', 'view_venue', args=[c.id]),
+                           num_of_iterations=num_of_iterations,
+                           checkpoint=True,
+                           tolerance=ranker.REP_SYS_TOLERANCE,
+                           num_chains=ranker.REP_SYS_NUM_CHAINS)
     return dict(venue_form=venue_form, confirmation_form=confirmation_form)
+
+
+def submit_ranking_job(c, job_type, redirect_url, **params):
+    """Submits a ranking job for venue c and redirects to the job status.
+    If the venue has already a computation in progress, redirects to redirect_url."""
+    job_id = jobs.submit_job(db, c.id, job_type, auth.user.email, **params)
+    if job_id is None:
+        session.flash = T('Another computation is in progress for this venue.')
+        redirect(redirect_url)
+    db.commit()
+    session.flash = T('The computation has been started.')
+    redirect(URL('rating', 'view_job', args=[job_id]))
+
+
+@auth.requires_login()
+def view_job():
+    """Shows status and progress of a ranking job."""
+    job = db.ranking_job(request.args(0)) or redirect(URL('default', 'index'))
+    check_manager_eligibility(job.venue_id, auth.user.email, 'Not authorized.')
+    is_active = job.status in [jobs.QUEUED, jobs.RUNNING]
+    return dict(job=job, is_active=is_active, duration=jobs.get_duration(job))
+
+
+@auth.requires_login()
+def cancel_job():
+    """Cancels a queued or running ranking job."""
+    job = db.ranking_job(request.args(0)) or redirect(URL('default', 'index'))
+    check_manager_eligibility(job.venue_id, auth.user.email, 'Not authorized.')
+    confirmation_form = FORM.confirm(T('Cancel computation'),
+        {T('Back'): URL('rating', 'view_job', args=[job.id])})
+    if confirmation_form.accepted:
+        if jobs.cancel_job(db, job.id):
+            session.flash = T('The computation has been canceled.')
+        else:
+            session.flash = T('The computation is not in progress.')
+        redirect(URL('rating', 'view_job', args=[job.id]))
+    return dict(job=job, confirmation_form=confirmation_form)
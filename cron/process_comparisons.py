@@ -0,0 +1,25 @@
+# coding: utf8
+# Processes comparisons queued by the rating controller (see
+# ranker.process_comparison_queue).
+#
+# It is run every minute by web2py cron (see cron/crontab), or it can run
+# as a long-lived worker:
+#   python web2py.py -S crowdranker -M -R applications/crowdranker/cron/process_comparisons.py -A loop
+# Cron runs and the worker can overlap, the queue is processed by one of
+# them at a time.
+
+import sys
+import time
+import ranker
+
+# Seconds to wait before polling an empty queue again.
+POLL_INTERVAL = 5
+
+if 'loop' in sys.argv[1:]:
+    while True:
+        if ranker.process_comparison_queue(db) == 0:
+            # Ends the transaction, so the next poll sees new comparisons.
+            db.commit()
+            time.sleep(POLL_INTERVAL)
+else:
+    ranker.process_comparison_queue(db)
@@ -0,0 +1,23 @@
+# coding: utf8
+# Runs the reputation system for all active venues which have new
+# comparisons since their final grades were computed, and prints a summary.
+# The cpus are split among venues run in parallel and the chains of each
+# venue (see jobs.recompute_stale_venues): chains stay the same as in runs
+# started from the venue page, so checkpoints of both can be resumed.
+#
+# It is run every night by web2py cron (see cron/crontab), or from the
+# command line, optionally with the number of venues run in parallel:
+#   python web2py.py -S crowdranker -M -R applications/crowdranker/cron/recompute_venues.py -A 8
+
+import sys
+import jobs
+import ranker
+
+num_processes = None
+if len(sys.argv) > 1:
+    num_processes = int(sys.argv[1])
+print jobs.recompute_stale_venues(db, 'cron', num_processes=num_processes,
+                                  num_of_iterations=ranker.REP_SYS_MAX_ITERATIONS,
+                                  checkpoint=True,
+                                  tolerance=ranker.REP_SYS_TOLERANCE,
+                                  num_chains=ranker.REP_SYS_NUM_CHAINS)
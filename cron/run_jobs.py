@@ -0,0 +1,22 @@
+# coding: utf8
+# Runs ranking jobs submitted by the rating controller (see modules/jobs.py).
+#
+# It is run every minute by web2py cron (see cron/crontab), or it can run
+# as a long-lived worker:
+#   python web2py.py -S crowdranker -M -R applications/crowdranker/cron/run_jobs.py -A loop
+
+import sys
+import time
+import jobs
+
+# Seconds to wait before polling for new jobs again.
+POLL_INTERVAL = 5
+
+if 'loop' in sys.argv[1:]:
+    while True:
+        if jobs.run_jobs(db) == 0:
+            # Ends the transaction, so the next poll sees new jobs.
+            db.commit()
+            time.sleep(POLL_INTERVAL)
+else:
+    jobs.run_jobs(db)
@@ -77,6 +77,7 @@ db.define_table('venue',
     Field('rater_contributions_visible_to_all', default=False),
     Field('number_of_submissions_per_reviewer', 'integer', default=6),
     Field('latest_rank_update_date', 'datetime'),
+    Field('rank_version', 'integer', default=0), # Incremented whenever qualities are written.
     Field('latest_reviewers_evaluation_date', 'datetime'),
     Field('latest_final_grades_evaluation_date', 'datetime'),
     Field('ranking_algo_description'),
@@ -114,6 +115,7 @@ db.venue.max_number_outstanding_reviews.requires = IS_INT_IN_RANGE(1, 100,
     error_message=T('Enter a number between 0 and 100.'))
 db.venue.max_number_outstanding_reviews.readable = db.venue.max_number_outstanding_reviews.writable = False
 db.venue.latest_rank_update_date.writable = False
+db.venue.rank_version.readable = db.venue.rank_version.writable = False
 db.venue.latest_reviewers_evaluation_date.writable = False
 db.venue.latest_final_grades_evaluation_date.writable = False
 db.venue.ranking_algo_description.writable = False
@@ -256,12 +258,14 @@ db.define_table('comparison', # An ordering of submissions, from Best to Worst.
     Field('submission_nicknames'), # This is a json dictionary mapping submission ids into strings for visualization
     Field('new_item', 'reference submission'),
     Field('is_valid', 'boolean', default=True),
+    Field('ordering_packed', 'blob'), # The ordering as an int32 array, see comparison_log.pack_ordering
     )
 
 db.comparison.grades.represent = represent_grades_compact
 db.comparison.venue_id.represent = represent_venue_id
 db.comparison.venue_id.label = T('Venue')
 db.comparison.submission_nicknames.readable = db.comparison.submission_nicknames.writable = False
+db.comparison.ordering_packed.readable = db.comparison.ordering_packed.writable = False
 
 def represent_ordering(v, r):
     if v is None:
@@ -276,6 +280,14 @@ def represent_ordering(v, r):
     except Exception, e:
 	return '-- data error --'
 
+# Comparisons waiting to be processed by the ranker, see
+# ranker.process_comparison_queue.
+db.define_table('comparison_queue',
+    Field('venue_id', db.venue),
+    Field('comparison_id', db.comparison),
+    Field('date', 'datetime', default=datetime.utcnow()),
+    )
+
 db.comparison.new_item.label = T('New submission')
 db.comparison.ordering.represent = represent_ordering
     
@@ -323,3 +335,23 @@ db.grades.user.writable = False
 db.grades.grade.represent = represent_double3
 db.grades.venue_id.represent = represent_venue_id
 db.grades.venue_id.label = T('Venue')
+
+# Long ranking computations (see modules/jobs.py), they are run by
+# cron/run_jobs.py outside of web requests.
+db.define_table('ranking_job',
+    Field('venue_id', db.venue),
+    Field('user', default=get_user_email()),
+    Field('job_type'),
+    Field('params', 'text'), # This is a json dictionary of arguments.
+    Field('status', default='queued'),
+    Field('progress', 'double', default=0.0),
+    Field('submitted_date', 'datetime', default=datetime.utcnow()),
+    Field('start_date', 'datetime'),
+    Field('end_date', 'datetime'),
+    Field('update_date', 'datetime'), # Last progress report of a running job.
+    Field('error', 'text'),
+    )
+
+db.ranking_job.venue_id.represent = represent_venue_id
+db.ranking_job.venue_id.label = T('Venue')
+db.ranking_job.job_type.label = T('Computation')
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding: utf8
+from gluon import *
+from gluon import portalocker
+import numpy as np
+import os
+import tempfile
+import util
+
+# Orderings are packed as little endian int32 arrays.
+PACKED_DTYPE = '<i4'
+
+# The log is stored as little endian int64 arrays, so that comparison ids
+# and offsets in the items of the log do not overflow.
+LOG_DTYPE = '<i8'
+
+# Number of comparison rows read from the db at a time when the log of a
+# venue is brought up to date.
+LOG_PAGE_SIZE = 1000
+
+# Number of values describing a comparison in the log: comparison id,
+# end of its ordering in the items of the log, index of the user, new item.
+INDEX_WIDTH = 4
+NO_NEW_ITEM = -1
+
+def pack_ordering(ordering):
+    """ Returns the ordering (list of submission ids) packed as a string,
+    to be stored in comparison.ordering_packed.
+    Raises ValueError if an id does not fit in PACKED_DTYPE. """
+    a = np.array(ordering, dtype=np.int64)
+    info = np.iinfo(PACKED_DTYPE)
+    if len(a) > 0 and (a.min() < info.min or a.max() > info.max):
+        raise ValueError("Submission ids of ordering %r cannot be packed" % ordering)
+    return a.astype(PACKED_DTYPE).tostring()
+
+def unpack_ordering(s):
+    """ Returns an int array with the ordering packed in s. """
+    return np.frombuffer(s, dtype=PACKED_DTYPE)
+
+def read_orderings(db, rows):
+    """ Returns a dictionary comparison id -> ordering (int array, from Best
+    to Worst) for rows, which have fields id and ordering_packed.
+    Orderings of comparisons which were not packed (they were made before
+    ordering_packed existed) are read from comparison.ordering.
+    """
+    orderings = {}
+    unpacked = []
+    for r in rows:
+        if r.ordering_packed:
+            orderings[r.id] = unpack_ordering(r.ordering_packed)
+        else:
+            unpacked.append(r.id)
+    if len(unpacked) > 0:
+        for r in db(db.comparison.id.belongs(unpacked)).select(
+                db.comparison.id, db.comparison.ordering):
+            orderings[r.id] = np.array(util.get_list(r.ordering), dtype=int)
+    return orderings
+
+def get_log_path(venue_id):
+    return os.path.join(current.request.folder, 'cache', 'comparison_log',
+                        'venue_%d.npy' % venue_id)
+
+def get_users_path(venue_id):
+    return os.path.join(current.request.folder, 'cache', 'comparison_log',
+                        'venue_%d_users.npy' % venue_id)
+
+def get_lock_path(venue_id):
+    return os.path.join(current.request.folder, 'cache', 'comparison_log',
+                        'venue_%d.lock' % venue_id)
+
+def save_array(path, a):
+    """ Saves a to path, replacing the file in one step, so readers never
+    see a partially written file. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            np.save(f, a)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class ComparisonLog(object):
+    """ The comparisons of a venue, in the order they were inserted (that
+    is, by id), stored as one LOG_DTYPE array:
+    [n, index (n rows of INDEX_WIDTH values), items]
+    where the items of comparison i are items[index[i - 1, 1]:index[i, 1]],
+    from Worst to Best. Users are stored in a separate array of strings.
+    The log is memory-mapped, so replaying comparisons does not parse
+    orderings and does not read the whole file in memory.
+    Comparisons are inserted with the current date, so the order of ids is
+    the order of dates, in which ranker.iter_comparisons reads them from
+    the db, unless dates are changed in the db.
+    """
+
+    def __init__(self, data, users):
+        n = int(data[0]) if len(data) > 0 else 0
+        self.index = data[1:1 + n * INDEX_WIDTH].reshape((n, INDEX_WIDTH))
+        self.items = data[1 + n * INDEX_WIDTH:]
+        self.users = users
+
+    @classmethod
+    def load(cls, venue_id):
+        """ Returns the log of the venue, or None if there is none, or if
+        its users file does not match it (then it is written again by
+        update_log). The log is read with the lock of update_log.
+        """
+        path = get_log_path(venue_id)
+        users_path = get_users_path(venue_id)
+        if not (os.path.exists(path) and os.path.exists(users_path)):
+            return None
+        log = cls(np.load(path, mmap_mode='r'), np.load(users_path))
+        if len(log) > 0 and log.index[:, 2].max() >= len(log.users):
+            return None
+        return log
+
+    def __len__(self):
+        return len(self.index)
+
+    def last_id(self):
+        """ Returns id of the last comparison of the log, or 0. """
+        if len(self.index) == 0:
+            return 0
+        return int(self.index[-1, 0])
+
+    def replay(self, invalid_ids=None, descending=False):
+        """ Yields a tuple (comparison_id, user, sorted_items, new_item) for
+        each comparison of the log, like ranker.iter_comparisons.
+        sorted_items is an int array from Worst to Best; comparisons whose
+        id is in invalid_ids, or of less than two items, are skipped.
+        """
+        if invalid_ids is None:
+            invalid_ids = set()
+        n = len(self.index)
+        idxs = xrange(n - 1, -1, -1) if descending else xrange(n)
+        for i in idxs:
+            comparison_id, end, user_idx, new_item = self.index[i]
+            start = self.index[i - 1, 1] if i > 0 else 0
+            if end - start < 2 or comparison_id in invalid_ids:
+                continue
+            if new_item == NO_NEW_ITEM:
+                new_item = None
+            yield (int(comparison_id), self.users[user_idx],
+                   self.items[start:end], new_item)
+
+
+def update_log(db, venue_id, page_size=LOG_PAGE_SIZE):
+    """ Brings the log of the venue up to date, appending the comparisons
+    inserted since it was last updated, and returns it.
+    Comparisons which are later invalidated stay in the log, they are
+    skipped when replaying it (see get_invalid_ids).
+    The log of a venue is updated and read by one process at a time, which
+    holds the lock file of the venue.
+    """
+    log_dir = os.path.dirname(get_log_path(venue_id))
+    if not os.path.exists(log_dir):
+        try:
+            os.makedirs(log_dir)
+        except OSError:
+            # Another process created it meanwhile.
+            if not os.path.isdir(log_dir):
+                raise
+    lock_file = open(get_lock_path(venue_id), 'a')
+    try:
+        portalocker.lock(lock_file, portalocker.LOCK_EX)
+        return update_locked_log(db, venue_id, page_size)
+    finally:
+        # Closing the file releases the lock.
+        lock_file.close()
+
+def update_locked_log(db, venue_id, page_size):
+    """ Updates the log of the venue, see update_log. """
+    log = ComparisonLog.load(venue_id)
+    if log is None:
+        index = np.zeros((0, INDEX_WIDTH), dtype=LOG_DTYPE)
+        items = np.zeros(0, dtype=LOG_DTYPE)
+        users = []
+    else:
+        index, items, users = log.index, log.items, list(log.users)
+    user_to_idx = dict((u, i) for i, u in enumerate(users))
+    last_id = 0 if log is None else log.last_id()
+    end = len(items)
+    new_index = []
+    new_items = []
+    c = db.comparison
+    while True:
+        rows = db((c.venue_id == venue_id) & (c.id > last_id)).select(
+            c.id, c.user, c.ordering_packed, c.new_item,
+            orderby=c.id, limitby=(0, page_size))
+        orderings = read_orderings(db, rows)
+        for r in rows:
+            if not user_to_idx.has_key(r.user):
+                user_to_idx[r.user] = len(users)
+                users.append(r.user)
+            # Orderings are stored from Best to Worst, the log from Worst to Best.
+            sorted_items = orderings[r.id][::-1]
+            end += len(sorted_items)
+            new_items.append(sorted_items)
+            new_index.append([r.id, end, user_to_idx[r.user],
+                              NO_NEW_ITEM if r.new_item is None else r.new_item])
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1].id
+    if len(new_index) == 0 and log is not None:
+        return log
+    index = np.concatenate([index, np.array(new_index, dtype=LOG_DTYPE).reshape(
+        (len(new_index), INDEX_WIDTH))])
+    items = np.concatenate([items] + [np.asarray(x, dtype=LOG_DTYPE) for x in new_items])
+    data = np.concatenate([np.array([len(index)], dtype=LOG_DTYPE),
+                           index.ravel(), items]).astype(LOG_DTYPE)
+    # Users are only appended, so the users file is written first: if the
+    # log cannot be written after it, the old log still matches its users.
+    save_array(get_users_path(venue_id), np.array(users))
+    save_array(get_log_path(venue_id), data)
+    return ComparisonLog.load(venue_id)
+
+def get_invalid_ids(db, venue_id):
+    """ Returns the set of ids of invalidated comparisons of the venue. """
+    rows = db((db.comparison.venue_id == venue_id) &
+              (db.comparison.is_valid == False)).select(db.comparison.id)
+    return set(r.id for r in rows)
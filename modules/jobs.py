@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# coding: utf8
+from gluon import *
+import gluon.contrib.simplejson as simplejson
+from datetime import datetime, timedelta
+import multiprocessing
+import multiprocessing.pool
+import time
+import traceback
+import ranker
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELED = 'canceled'
+
+# Seconds after which a running job which did not report progress is
+# considered dead (its worker was killed, or the server restarted), and is
+# marked as failed.
+JOB_TIMEOUT = 4 * 3600
+
+class JobCanceled(Exception):
+    pass
+
+# Functions which run a job of each type, they are called as
+# f(db, venue_id, progress, **params) where progress(x) reports that the
+# fraction x of the job is done. progress commits the progress report, so
+# they write their results after the last report, and do not commit: run_job
+# commits results only if the job is still running when they return. They
+# may return a function, which is called after the results are committed.
+JOB_FUNCTIONS = {
+    'recompute_ranks': lambda db, venue_id, progress, **params:
+        ranker.rerun_processing_comparisons(db, venue_id, progress=progress,
+                                            **params),
+    'run_reputation_system': lambda db, venue_id, progress, **params:
+        ranker.run_reputation_system(db, venue_id, progress=progress,
+                                     commit=False, **params),
+    'evaluate_contributors': lambda db, venue_id, progress, **params:
+        ranker.evaluate_contributors(db, venue_id, progress=progress),
+    'compute_final_grades': lambda db, venue_id, progress, **params:
+        ranker.compute_final_grades(db, venue_id, progress=progress,
+                                    commit=False),
+    }
+
+def expire_stale_jobs(db, venue_id=None):
+    """ Marks as failed the running jobs (of venue venue_id, or of all
+    venues) which did not report progress in the last JOB_TIMEOUT seconds.
+    Returns the number of expired jobs.
+    """
+    j = db.ranking_job
+    limit = datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT)
+    query = ((j.status == RUNNING) &
+             ((j.update_date < limit) |
+              ((j.update_date == None) & (j.start_date < limit))))
+    if venue_id is not None:
+        query &= (j.venue_id == venue_id)
+    return db(query).update(status = FAILED,
+                            end_date = datetime.utcnow(),
+                            error = 'The computation did not report progress for %d seconds.' % JOB_TIMEOUT)
+
+def get_active_job(db, venue_id):
+    """ Returns a queued or running job of the venue, or None. """
+    expire_stale_jobs(db, venue_id)
+    return db((db.ranking_job.venue_id == venue_id) &
+              (db.ranking_job.status.belongs([QUEUED, RUNNING]))).select(
+              orderby=db.ranking_job.id).first()
+
+def submit_job(db, venue_id, job_type, user, **params):
+    """ Submits a job of job_type for venue venue_id, params are passed to
+    the function which runs the job (see JOB_FUNCTIONS).
+    Returns id of the job, or None if the venue has already a queued or
+    running job.
+    The venue row is locked while checking for active jobs, so concurrent
+    submissions queue at most one job; the transaction is committed.
+    """
+    if not JOB_FUNCTIONS.has_key(job_type):
+        raise Exception('Unknown job type: %s' % job_type)
+    db(db.venue.id == venue_id).select(db.venue.id, for_update=True)
+    job_id = None
+    if get_active_job(db, venue_id) is None:
+        job_id = db.ranking_job.insert(venue_id = venue_id,
+                                       user = user,
+                                       job_type = job_type,
+                                       params = simplejson.dumps(params),
+                                       status = QUEUED,
+                                       progress = 0.0,
+                                       submitted_date = datetime.utcnow())
+    db.commit()
+    return job_id
+
+def cancel_job(db, job_id):
+    """ Cancels the job if it is queued or running.
+    A running job stops at its next progress report, and in any case its
+    results are rolled back (see run_job).
+    Returns True if the job was canceled.
+    """
+    n = db((db.ranking_job.id == job_id) &
+           (db.ranking_job.status.belongs([QUEUED, RUNNING]))).update(
+        status = CANCELED, end_date = datetime.utcnow())
+    db.commit()
+    return n > 0
+
+def get_duration(job):
+    """ Returns the number of seconds the job has been running, or None if
+    it did not start yet.
+    """
+    if job.start_date is None:
+        return None
+    end_date = job.end_date or datetime.utcnow()
+    d = end_date - job.start_date
+    return d.days * 86400 + d.seconds
+
+def run_job(db, job):
+    """ Runs the job and records its status, a failed job is rolled back.
+    Returns True if the job was run, False if it was taken by another worker
+    or its venue has a running job.
+    If the job is canceled or expired (see expire_stale_jobs) while it
+    runs, its results are rolled back, they are committed only together
+    with the done status of the job.
+    """
+    running = db((db.ranking_job.venue_id == job.venue_id) &
+                 (db.ranking_job.status == RUNNING)).count()
+    if running > 0:
+        return False
+    # Claiming the job, only one worker can move it from the queue.
+    now = datetime.utcnow()
+    n = db((db.ranking_job.id == job.id) &
+           (db.ranking_job.status == QUEUED)).update(status = RUNNING,
+                                                     start_date = now,
+                                                     update_date = now)
+    db.commit()
+    if n == 0:
+        return False
+    is_running = ((db.ranking_job.id == job.id) &
+                  (db.ranking_job.status == RUNNING))
+    def progress(x):
+        # The progress report is also the heartbeat of the job.
+        if db(is_running).update(progress = x,
+                                 update_date = datetime.utcnow()) == 0:
+            raise JobCanceled()
+        db.commit()
+    params = dict((str(k), v) for k, v in simplejson.loads(job.params or '{}').iteritems())
+    after_commit = None
+    try:
+        after_commit = JOB_FUNCTIONS[job.job_type](db, job.venue_id, progress,
+                                                   **params)
+        if db(is_running).update(status = DONE,
+                                 progress = 1.0,
+                                 end_date = datetime.utcnow()) == 0:
+            # Canceled or expired while running.
+            db.rollback()
+            after_commit = None
+    except JobCanceled:
+        db.rollback()
+    except Exception:
+        db.rollback()
+        db(is_running).update(status = FAILED,
+                              end_date = datetime.utcnow(),
+                              error = traceback.format_exc())
+        after_commit = None
+    db.commit()
+    if after_commit is not None:
+        after_commit()
+    return True
+
+def run_jobs(db):
+    """ Runs all queued jobs in the order they were submitted.
+    Returns the number of jobs run.
+    """
+    expire_stale_jobs(db)
+    db.commit()
+    jobs = db(db.ranking_job.status == QUEUED).select(orderby=db.ranking_job.id)
+    return len([job for job in jobs if run_job(db, job)])
+
+def get_stale_venues(db):
+    """ Returns ids of active venues which have comparisons made after their
+    final grades were last computed, or which have comparisons and never
+    had final grades computed.
+    On the Google datastore, which has no joins, the last comparison of
+    each active venue is read instead.
+    """
+    v, c = db.venue, db.comparison
+    if ranker.uses_datastore(db):
+        venue_ids = []
+        for venue in db(v.is_active == True).select(v.id, v.latest_final_grades_evaluation_date):
+            last = db(c.venue_id == venue.id).select(c.date, orderby=~c.date,
+                                                     limitby=(0, 1)).first()
+            if last is not None and (venue.latest_final_grades_evaluation_date is None or
+                                     last.date > venue.latest_final_grades_evaluation_date):
+                venue_ids.append(venue.id)
+        return venue_ids
+    query = ((c.venue_id == v.id) & (v.is_active == True) &
+             ((v.latest_final_grades_evaluation_date == None) |
+              (c.date > v.latest_final_grades_evaluation_date)))
+    return [r.id for r in db(query).select(v.id, distinct=True)]
+
+# Connection to the db of a worker process of run_jobs_in_pool.
+worker_db = None
+
+class WorkerProcess(multiprocessing.Process):
+    """ A process which is never daemonic: pool processes are daemonic by
+    default, and daemonic processes cannot start processes of their own,
+    such as the chains of the reputation system (see ranker.RepSysChains).
+    """
+    def _get_daemon(self):
+        return False
+    def _set_daemon(self, value):
+        pass
+    daemon = property(_get_daemon, _set_daemon)
+
+class WorkerPool(multiprocessing.pool.Pool):
+    Process = WorkerProcess
+
+def init_worker(uri, folder):
+    """ Opens the db connection of a worker process. Connections cannot be
+    shared with the parent process, so the worker opens its own, with the
+    table definitions saved by the models in folder.
+    """
+    global worker_db
+    worker_db = DAL(uri, folder=folder, auto_import=True)
+
+def run_job_in_worker(job_id):
+    """ Runs job job_id with the db of the worker process.
+    Returns a tuple (job_id, ran, seconds), see run_job.
+    """
+    t = time.time()
+    job = worker_db.ranking_job(job_id)
+    ran = job is not None and run_job(worker_db, job)
+    return job_id, ran, time.time() - t
+
+def run_jobs_in_pool(db, job_ids, num_processes=None):
+    """ Runs jobs job_ids in a pool of num_processes processes (by default,
+    one per cpu), each venue in a new process with its own db connection.
+    Workers are not daemonic, so jobs can use processes of their own.
+    Returns a list of tuples (job, ran, seconds), see run_job_in_worker.
+    """
+    # Workers have to see the submitted jobs.
+    db.commit()
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    num_processes = max(1, min(num_processes, len(job_ids)))
+    pool = WorkerPool(num_processes, initializer=init_worker,
+                      initargs=(db._uri, db._folder), maxtasksperchild=1)
+    try:
+        results = pool.map(run_job_in_worker, job_ids, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    # Ends the transaction, so the jobs are read as the workers left them.
+    db.commit()
+    return [(db.ranking_job(job_id), ran, seconds)
+            for job_id, ran, seconds in results]
+
+def recompute_stale_venues(db, user, num_processes=None, **params):
+    """ Runs the reputation system, with params, for all venues returned by
+    get_stale_venues, in parallel (see run_jobs_in_pool). Venues which
+    have already a queued or running job are skipped.
+    If params has num_chains, each venue runs its chains in parallel, so
+    by default the cpus are split among venues: num_processes is the
+    number of cpus divided by num_chains.
+    Returns a summary of the runs as a string.
+    """
+    t = time.time()
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count() // (params.get('num_chains') or 1)
+    venue_ids = get_stale_venues(db)
+    job_ids = []
+    skipped = []
+    for venue_id in venue_ids:
+        job_id = submit_job(db, venue_id, 'run_reputation_system', user, **params)
+        if job_id is None:
+            skipped.append(venue_id)
+        else:
+            job_ids.append(job_id)
+    results = []
+    if len(job_ids) > 0:
+        results = run_jobs_in_pool(db, job_ids, num_processes=num_processes)
+    lines = []
+    for job, ran, seconds in results:
+        if ran:
+            lines.append('venue %d: %s in %.1f s' % (job.venue_id, job.status, seconds))
+        else:
+            lines.append('venue %d: %s, left to the job queue' % (job.venue_id, job.status))
+    for venue_id in skipped:
+        lines.append('venue %d: skipped, it has a computation in progress' % venue_id)
+    busy = sum(seconds for job, ran, seconds in results if ran)
+    lines.append('%d venues in %.1f s (%.1f s of computation)' %
+                 (len(venue_ids), time.time() - t, busy))
+    return '\n'.join(lines)
@@ -6,52 +6,167 @@ import random
 import time
 import math
 
+# Values smaller than TINY are replaced by TINY in continued fractions,
+# to avoid divisions by zero.
+TINY = 1e-300
+
+# Accuracies of reviewers are quantiles of Beta distributions restricted to
+# [DIRICHLET_MIN_Q, 1 - DIRICHLET_MIN_Q] (see
+# Rank.evaluate_orderings_using_dirichlet).
+DIRICHLET_MIN_Q = 0.001
+
+def beta_continued_fraction(a, b, x, eps=1e-14, max_iter=1000):
+    """ Evaluates the continued fraction of the regularized incomplete beta
+    function (modified Lentz's method) elementwise on arrays a, b, x.
+    It converges quickly for x < (a + 1) / (a + b + 2).
+    """
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = np.ones_like(x)
+    d = 1.0 - qab * x / qap
+    d = 1.0 / np.where(np.abs(d) < TINY, TINY, d)
+    h = d.copy()
+    for m in xrange(1, max_iter + 1):
+        m2 = 2 * m
+        # Even step.
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / np.where(np.abs(d) < TINY, TINY, d)
+        c = 1.0 + aa / c
+        c = np.where(np.abs(c) < TINY, TINY, c)
+        h *= d * c
+        # Odd step.
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / np.where(np.abs(d) < TINY, TINY, d)
+        c = 1.0 + aa / c
+        c = np.where(np.abs(c) < TINY, TINY, c)
+        delta = d * c
+        h *= delta
+        if np.all(np.abs(delta - 1.0) < eps):
+            break
+    return h
+
+def log_beta(a, b):
+    """ Returns log(B(a, b)) elementwise for arrays a, b. """
+    return np.array([math.lgamma(u) + math.lgamma(v) - math.lgamma(u + v)
+                     for u, v in zip(a.ravel(), b.ravel())]).reshape(a.shape)
+
+def beta_cdf(x, a, b, lbeta=None):
+    """ Returns the regularized incomplete beta function I_x(a, b), i.e. the
+    cumulative distribution function at x of the Beta distribution with
+    parameters a, b, elementwise for arrays x, a, b.
+    lbeta is log_beta(a, b), if it is already known.
+    """
+    x, a, b = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                  np.asarray(a, dtype=np.float64),
+                                  np.asarray(b, dtype=np.float64))
+    if lbeta is None:
+        lbeta = log_beta(a, b)
+    inside = (x > 0) & (x < 1)
+    xs = np.where(inside, x, 0.5)
+    # The factor x^a (1 - x)^b / B(a, b) is computed in logarithms, so it
+    # does not overflow for large a, b.
+    front = np.exp(a * np.log(xs) + b * np.log1p(-xs) - lbeta)
+    # Otherwise I_x(a, b) = 1 - I_{1-x}(b, a) is used, for which the
+    # continued fraction converges quickly.
+    direct = xs < (a + 1.0) / (a + b + 2.0)
+    aa = np.where(direct, a, b)
+    bb = np.where(direct, b, a)
+    xx = np.where(direct, xs, 1.0 - xs)
+    cf = front * beta_continued_fraction(aa, bb, xx) / aa
+    result = np.where(direct, cf, 1.0 - cf)
+    return np.where(x <= 0, 0.0, np.where(x >= 1, 1.0, result))
+
+def beta_ppf(p, a, b, lo=0.0, hi=1.0, tol=1e-8):
+    """ Returns the p-quantile of the Beta distribution with parameters a, b
+    restricted to the interval [lo, hi], elementwise for arrays p, a, b.
+    The quantile is found by bisection up to tol, which cannot diverge even
+    when the density is unbounded at 0 or 1.
+    """
+    p, a, b = np.broadcast_arrays(np.asarray(p, dtype=np.float64),
+                                  np.asarray(a, dtype=np.float64),
+                                  np.asarray(b, dtype=np.float64))
+    lbeta = log_beta(a, b)
+    cdf_lo = beta_cdf(lo, a, b, lbeta)
+    cdf_hi = beta_cdf(hi, a, b, lbeta)
+    target = cdf_lo + p * (cdf_hi - cdf_lo)
+    num_iter = int(math.ceil(math.log((hi - lo) / tol, 2)))
+    lo = np.zeros(p.shape) + lo
+    hi = np.zeros(p.shape) + hi
+    for i in xrange(num_iter):
+        mid = (lo + hi) / 2.0
+        below = beta_cdf(mid, a, b, lbeta) < target
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+    return (lo + hi) / 2.0
+
 class Cost:
     """ Class contains cost function.
     """
     def __init__(self, cost_type='top-k', rank_cost_coefficient=-1):
         self.cost_type = cost_type
         self.rank_cost_coefficient = rank_cost_coefficient
+        # Cost function is chosen once, each of them works on a single rank
+        # as well as on a vector of ranks.
+        self.cost_fn = {
+            'top-k': self._top_k,
+            'one_over_rank': self._one_over_rank,
+            'rank_power_alpha': self._rank_power_alpha,
+            'two_steps': self._two_steps,
+            'piecewise': self._piecewise,
+            'smooth-top-k': self._smooth_top_k,
+        }.get(cost_type)
 
     def calculate(self, i, k, id2rank):
-        # ranking starts from 0, so first k rank are 0, 1, ..., k - 1
-        if self.cost_type == 'top-k':
-            if id2rank[i] < k:
-                return 1
-            else:
-                return 0
-        elif self.cost_type == 'one_over_rank':
-            return  1./( 1 + id2rank[i])
-        elif self.cost_type == 'rank_power_alpha':
-            if self.rank_cost_coefficient == 0:
-                raise Exception("If coefficient is zero then cost object should be None!")
-            return (1 + id2rank[i]) ** self.rank_cost_coefficient
-        elif self.cost_type == 'two_steps':
-            if id2rank[i] < k:
-                return 1
-            if id2rank[i] < 3 * k / 2:
-                return 0.5
-            return 0
-        elif self.cost_type == 'piecewise':
-            a = 0.25
-            x = id2rank[i]
-            if x < k:
-                return (-1) * a / k * x + 1 + a
-            if x < 2 * k:
-                return - 1. / k * x + 2
-            return 0
-        elif self.cost_type == 'smooth-top-k':
-            beta = 2
-            return 1.0 / (1 + (id2rank[i]/float(k)) ** beta)
-        else:
+        """ Returns cost of the item with id i. """
+        return float(self.calculate_ranks(id2rank[i], k))
+
+    def calculate_vector(self, k, id2rank):
+        """ Returns vector c such that c[i] is cost of the item with id i,
+        costs of all items are computed at once.
+        """
+        return self.calculate_ranks(np.asarray(id2rank), k)
+
+    def calculate_ranks(self, ranks, k):
+        """ Returns costs of items with given ranks. """
+        if self.cost_fn is None:
             raise Exception('Cost funtion type is not specified')
+        return self.cost_fn(ranks, k)
+
+    # Ranking starts from 0, so first k rank are 0, 1, ..., k - 1
+
+    def _top_k(self, x, k):
+        return np.where(x < k, 1.0, 0.0)
+
+    def _one_over_rank(self, x, k):
+        return 1. / (1 + x)
+
+    def _rank_power_alpha(self, x, k):
+        if self.rank_cost_coefficient == 0:
+            raise Exception("If coefficient is zero then cost object should be None!")
+        return (1.0 + x) ** self.rank_cost_coefficient
+
+    def _two_steps(self, x, k):
+        return np.where(x < k, 1.0, np.where(x < 3 * k / 2, 0.5, 0.0))
+
+    def _piecewise(self, x, k):
+        a = 0.25
+        return np.where(x < k, (-1) * a / k * x + 1 + a,
+                        np.where(x < 2 * k, - 1. / k * x + 2, 0.0))
+
+    def _smooth_top_k(self, x, k):
+        beta = 2
+        return 1.0 / (1 + (x / float(k)) ** beta)
 
 
 class Rank:
     """ Class contains methods for ranking items based on items comparison.
     """
     def __init__(self, items, alpha=0.9, num_bins=2001,
-                 cost_obj=None, k=None, init_dist_type='gauss'):
+                 cost_obj=None, k=None, init_dist_type='gauss',
+                 dtype=np.float64, bin_width=1.0):
         """
         Arguments:
             - items is a list of original items id.
@@ -61,33 +176,45 @@ class Rank:
             - num_bins is the number of histogram bins.
             - cost_obj is an object of type Cost, in other words it is reward
             - init_distr_type is type of ditribution we use for initialization
-              quality distributions
+              quality distributions. If it is None then distributions are
+              left uninitialized and have to be filled by the caller
+              (see from_qdistr_param).
+            - dtype is the numpy type of quality distributions, np.float32
+              halves memory and bandwidth at the price of precision.
+            - bin_width is the distance in quality between two neighbour
+              bins. Means and stdevs (see get_qdistr_parameters) are in units
+              of quality, so num_bins=201 and bin_width=10 give a coarse
+              grid over the same range of qualities as num_bins=2001.
         """
         # items are indexed by 0, 1, ..., num_items - 1 in the class but
         # "outside" they have ids from orig_items_id, so orig_items_id[n]
-        # is original id of item n.
+        # is original id of item n and id2idx[orig_items_id[n]] is n.
         self.orig_items_id = items
+        self.id2idx = dict((x, i) for i, x in enumerate(items))
         num_items = len(items)
         self.num_items = num_items
         self.num_bins = num_bins
         self.cost_obj = cost_obj
         self.alpha = alpha
+        self.dtype = dtype
+        self.bin_width = bin_width
+        # Bin values and their squares, used to compute moments of
+        # quality distributions as matrix-vector products.
+        self.bins = bin_width * np.arange(num_bins, dtype=np.float64)
+        self.bins_sq = self.bins * self.bins
         # Constant k is for top-k problems.
         self.k = k
         # qdistr is numpy two dimensional array which represents quality
         # distribution, i-th row is a distribution for an item with id equals i.
         # qdistr is initialized as uniform distribution.
         if init_dist_type == 'unif':
-            self.qdistr = np.zeros((num_items ,num_bins)) + 1./num_bins
+            self.qdistr = np.zeros((num_items ,num_bins), dtype=dtype) + 1./num_bins
         elif init_dist_type == 'gauss':
             # Does a Gaussian distribution centered in the center.
-            #print num_items, num_bins
-            x, y = np.mgrid[0:num_items, 0:num_bins]
-            self.qdistr = np.zeros((self.num_items, self.num_bins))
-            for i in xrange(self.num_items):
-                self.qdistr[i, :] = self.get_normal_vector(self.num_bins,
-                                                        self.num_bins / 2,
-                                                        self.num_bins / 8)
+            # All the rows are the same, so we compute only one of them.
+            d = self.get_normal_vector(self.num_bins, self.num_bins / 2,
+                                       self.num_bins / 8)
+            self.qdistr = np.tile(d.astype(dtype), (num_items, 1))
             #self.qdistr = scipy.stats.distributions.norm.pdf(y, loc=num_bins / 2, scale = num_bins / 8)
 
             # Normalization.
@@ -98,12 +225,24 @@ class Rank:
             #plt.draw()
             #time.sleep(2)
             #plt.close('all')
+        else:
+            self.qdistr = np.empty((num_items, num_bins), dtype=dtype)
+        # qcdf[i, :] is cumulative distribution of qdistr[i, :], rows are
+        # computed on demand by get_cdf and qcdf_dirty[i] tells whether
+        # the row i is outdated. qcdf is None if all rows are outdated.
+        self.qcdf = None
+        self.qcdf_dirty = None
+        # Indices of pairs of items of orderings of length n, see
+        # get_dirichlet_parameters.
+        self.triu_indices = {}
 
-        self.rank2id, self.id2rank = self.compute_ranks(self.qdistr)
-        # generate true items quality and rank
-        self.generate_true_items_quality()
-        self.rank2id_true, self.id2rank_true = \
-                                            self.compute_ranks(self.qdistr_true)
+        if not init_dist_type is None:
+            self.init_ranks()
+        # True items quality and rank are used in simulations. The item with
+        # id i has true quality i + 1, which is what compute_ranks returns
+        # for the distributions built by generate_true_items_quality.
+        self.rank2id_true = np.arange(self.num_items)[::-1]
+        self.id2rank_true = self.rank2id_true.argsort()
         # Computing true quality vector; quality_true[i] is true quality
         # of item i.
         #self.quality_true = self.avg(self.qdistr_true)
@@ -111,7 +250,8 @@ class Rank:
 
     @classmethod
     def from_qdistr_param(cls, items, qdistr_param, alpha=0.6,
-                         num_bins=2001, cost_obj=None):
+                         num_bins=2001, cost_obj=None, dtype=np.float64,
+                         bin_width=1.0):
         """ Alternative constructor for creating rank object
         from quality distributions parameters.
         Arguments are the same like in __init__ method but qdistr_param
@@ -119,10 +259,39 @@ class Rank:
         and qdistr[2*i + 1] are mean and stdev for items[i].
         """
         result = cls(items, alpha, num_bins, cost_obj,
-                     k=None, init_dist_type='gauss')
+                     k=None, init_dist_type=None, dtype=dtype,
+                     bin_width=bin_width)
         result.restore_qdistr_from_parameters(qdistr_param)
         return result
 
+    @classmethod
+    def from_qdistr(cls, items, qdistr, alpha=0.6, cost_obj=None,
+                    bin_width=1.0):
+        """ Alternative constructor for creating rank object from quality
+        distributions qdistr, such that qdistr[i, :] is the distribution of
+        items[i] (for instance, the qdistr of a saved rank object).
+        """
+        qdistr = np.array(qdistr)
+        result = cls(items, alpha, qdistr.shape[1], cost_obj,
+                     k=None, init_dist_type=None, dtype=qdistr.dtype,
+                     bin_width=bin_width)
+        result.qdistr = qdistr
+        result.invalidate_cdf()
+        result.init_ranks()
+        return result
+
+    def get_indices(self, ids):
+        """ Returns list of indices of items with original ids ids. """
+        return [self.id2idx[x] for x in ids]
+
+    def get_mask(self, ids):
+        """ Returns boolean array m such that m[i] is True if the original id
+        of item i is in ids. Ids which are not ids of items are ignored.
+        """
+        mask = np.zeros(self.num_items, dtype=bool)
+        mask[[self.id2idx[x] for x in ids if x in self.id2idx]] = True
+        return mask
+
     def get_normal_vector(self, num_bins, average, stdev):
         x_array = np.arange(num_bins)
         dist = x_array - average
@@ -131,6 +300,23 @@ class Rank:
         d = d / np.sum(d)
         return d
 
+    def get_normal_matrix(self, num_bins, averages, stdevs, dtype=np.float64):
+        """ Returns matrix m such that m[i, :] is
+        get_normal_vector(num_bins, averages[i], stdevs[i]).
+        All the rows are computed at once.
+        """
+        averages = np.asarray(averages, dtype=dtype)[:, np.newaxis]
+        stdevs = np.asarray(stdevs, dtype=dtype)[:, np.newaxis]
+        d = np.arange(num_bins, dtype=dtype) - averages
+        d *= d
+        d /= -2.0 * stdevs * stdevs
+        # Subtracting the maximum keeps at least one bin nonzero for narrow
+        # distributions whose mean falls between bins of a coarse grid.
+        d -= np.max(d, 1)[:, np.newaxis]
+        np.exp(d, out=d)
+        d /= np.sum(d, 1)[:, np.newaxis]
+        return d
+
     #def plot_distributions(self, hold=False, **kwargs):
     #    plt.clf()
     #    for i in range(self.num_items):
@@ -168,37 +354,103 @@ class Rank:
         id2rank = rank2id.argsort()
         return rank2id, id2rank
 
+    def init_ranks(self):
+        """ Computes average qualities (self.item_avrg) and ranks of all
+        items from scratch.
+        """
+        self.item_avrg = self.avg(self.qdistr)
+        self.rank2id = self.item_avrg.argsort()[::-1]
+        self.id2rank = self.rank2id.argsort()
+
+    def update_ranks(self, idxs):
+        """ Updates self.item_avrg, rank2id and id2rank given that only
+        distributions of items idxs have changed.
+        Averages are recomputed only for items idxs, the rest of items keep
+        their relative order, so changed items are removed from rank2id and
+        inserted back by binary search.
+        """
+        idxs = np.unique(idxs)
+        self.item_avrg[idxs] = self.avg(self.qdistr[idxs, :])
+        # rank2id is sorted by decreasing average, so we search in negated
+        # averages which are increasing.
+        rest = self.rank2id[~np.in1d(self.rank2id, idxs)]
+        keys = -self.item_avrg[rest]
+        order = np.argsort(-self.item_avrg[idxs], kind='mergesort')
+        idxs = idxs[order]
+        pos = keys.searchsorted(-self.item_avrg[idxs])
+        self.rank2id = np.insert(rest, pos, idxs)
+        self.id2rank[self.rank2id] = np.arange(self.num_items)
+
     def compute_percentile(self):
+        """ Returns vector id2percentile such that id2percentile[i] is
+        the percentile of the item with id i.
+        """
         # Rank is from 0, 1, ..., num_items - 1
         val = 100 / float(self.num_items)
-        id2percentile = {}
-        for idx in xrange(self.num_items):
-            id2percentile[idx] = val * (self.num_items - self.id2rank[idx])
-        return id2percentile
+        return val * (self.num_items - self.id2rank)
 
     def avg(self, quality_distr):
         """ returns vector v with average qualities for each item.
         v[i] is the average quality of the item with id i.
         """
-        # grid_b is a matrix consisting of vertically stacked vector
-        # (0, 1, ..., num_bins - 1)
-        grid_b, _ = np.meshgrid(np.arange(self.num_bins),
-                                     np.arange(self.num_items))
         # Actually values are from 1 to num_bins.
-        grid_b = grid_b + 1
         # avg[i] is expected value of quality distribution for item with id i.
-        avg = np.sum(quality_distr * grid_b, 1)
+        avg = np.dot(quality_distr, self.bins + 1)
         return avg
 
+    def get_cdf(self, idxs):
+        """ Returns matrix with cumulative distributions of items idxs.
+        Cumulative distributions are cached, only outdated rows are
+        recomputed.
+        """
+        if self.qcdf is None:
+            self.qcdf = np.empty_like(self.qdistr)
+            self.qcdf_dirty = np.ones(self.num_items, dtype=bool)
+        idxs = np.asarray(idxs)
+        dirty = np.unique(idxs[self.qcdf_dirty[idxs]])
+        if len(dirty) > 0:
+            self.qcdf[dirty, :] = np.cumsum(self.qdistr[dirty, :], 1)
+            self.qcdf_dirty[dirty] = False
+        return self.qcdf[idxs, :]
+
+    def invalidate_cdf(self, idxs=None):
+        """ Marks cached cumulative distributions of items idxs as outdated.
+        If idxs is None then all of them are outdated.
+        """
+        if idxs is None:
+            self.qcdf = None
+            self.qcdf_dirty = None
+        elif not self.qcdf is None:
+            self.qcdf_dirty[idxs] = True
+
+    def compute_moments(self, idxs=None):
+        """ Returns tuple (mean, stdev) of vectors with means and standard
+        deviations of quality distributions of items idxs.
+        If idxs is None then moments are computed for all items.
+        """
+        if idxs is None:
+            qdistr = self.qdistr
+        else:
+            qdistr = self.qdistr[idxs, :]
+        mean = np.dot(qdistr, self.bins)
+        # Variance is E[x^2] - E[x]^2, it is clipped at zero to absorb
+        # rounding errors of very narrow distributions.
+        var = np.dot(qdistr, self.bins_sq) - mean * mean
+        return mean, np.sqrt(np.maximum(var, 0))
+
 
     def update(self, sorted_items, new_item=None, alpha_annealing=None, 
-               annealing_type='before_normalization_uniform'):
+               annealing_type='before_normalization_uniform',
+               changed_only=False):
         """ Main update function.
         Given sorted_items and new_item it updates quality distributions and
         items ranks.
         Method returns dictionary d such that d['sumbission id'] is a list
         [percentile, average, stdev], i.e. percentile of the submission,
         average and stdev of quaility distribution of it.
+        If changed_only is True then d contains only items from sorted_items,
+        which is much cheaper when many comparisons are processed one after
+        another; get_result() returns the dictionary for all items.
 
         If alpha_annealing is None then we use old self.alpha otherwise we
         set self.alpha to alpha_annealing.
@@ -223,20 +475,32 @@ class Rank:
             alpha_old = self.alpha
             self.alpha = alpha_annealing
         # Obtaining ordering in terms of internal ids.
-        sorted_ids = [self.orig_items_id.index(x) for x in sorted_items]
+        sorted_ids = self.get_indices(sorted_items)
         self.n_comparisons_update(sorted_ids, annealing_type)
-        id2percentile = self.compute_percentile()
-        qdistr_param = self.get_qdistr_parameters()
-        result = {}
-        for idx in xrange(self.num_items):
-            avrg = qdistr_param[2 * idx]
-            stdev = qdistr_param[2 * idx + 1]
-            result[self.orig_items_id[idx]] = (id2percentile[idx], avrg, stdev)
+        if changed_only:
+            result = self.get_result(sorted_ids)
+        else:
+            result = self.get_result()
         # Setting old alpha back.
         if not alpha_old is None:
             self.alpha = alpha_old
         return result
 
+    def get_result(self, idxs=None):
+        """ Returns dictionary d such that d['submission id'] is a tuple
+        (percentile, average, stdev) for items with internal ids idxs.
+        If idxs is None then all items are in d.
+        """
+        id2percentile = self.compute_percentile()
+        mean, stdev = self.compute_moments(idxs)
+        if idxs is None:
+            idxs = range(self.num_items)
+        result = {}
+        for i, idx in enumerate(idxs):
+            result[self.orig_items_id[idx]] = (id2percentile[idx], mean[i],
+                                               stdev[i])
+        return result
+
 
     def get_ranking_error_inthe_end_of_round(self, num_items_to_compare):
         """
@@ -304,134 +568,148 @@ class Rank:
             - 'before_normalization_gauss' works best in presence of gaussian
             users (users who can swap similar items).
         """
-        n = len(descend_list)
+        self.n_comparisons_update_batch([descend_list],
+                                        annealing_type=annealing_type)
+        # Update id2rank and rank2id vectors, only items from descend_list
+        # have changed their distributions.
+        self.update_ranks(descend_list)
+
+    def n_comparisons_update_batch(self, descend_lists, alphas=None,
+                                   annealing_type='before_normalization_uniform'):
+        """ Updates quality distributions given m orderings of n items each.
+        All orderings are processed at once as (m, n, num_bins) arrays, so
+        orderings have to be of the same length and no item can appear in
+        two orderings (then the result is the same as processing them one
+        after another with n_comparisons_update).
+        Ranks are not updated, it is up to the caller to call update_ranks.
+
+        Arguments:
+            - descend_lists is a list of orderings, each of them is like
+            descend_list in n_comparisons_update.
+            - alphas is a list with annealing coefficient for each ordering,
+            if it is None then self.alpha is used for all of them.
+            - annealing_type is the same as in n_comparisons_update.
+        """
+        descend_lists = np.asarray(descend_lists)
+        m, n = descend_lists.shape
+        if alphas is None:
+            alpha = self.alpha
+        else:
+            alpha = np.asarray(alphas, dtype=np.float64)[:, np.newaxis,
+                                                         np.newaxis]
         factorial = math.factorial(n)
+        # q[k, i, :] is distribution of item descend_lists[k, i].
+        q = self.qdistr[descend_lists, :]
         # Let's denote quality of element descend_list[i] as zi, then
         # z0 < z1 < ... < z(n-1) where n is length of descend_list.
 
-        # v[0, x] = Pr(x < z(n-1))
-        # v[1, x] = Pr(x < z(n-2) < z(n-1))
-        # v[i, x] = Pr(x < z(n-1-i) < ... < z(n-1))
-        # v[n-2, x] = Pr(x < z1 < ... < z(n-1))
-        v = np.zeros((n - 1, self.num_bins))
-        q = self.qdistr[descend_list[n-1], :]
-        v[0,:] = 1 - np.cumsum(q)
-
-        # w[0, x] = Pr(z0 < x)
-        # w[1, x] = Pr(z0 < z1 < x)
-        # w[i, x] = Pr(z0 < z1 < ... < z(i) < x)
-        # w[n-2, x] = Pr(z0 < z1 < ... < z(n-2) < x)
-        w = np.zeros((n - 1, self.num_bins))
-        q = self.qdistr[descend_list[0], :]
-        w[0,:] = np.cumsum(q) - q
-
-        # Filling v and w.
+        # v[i, k, x] = Pr(x < z(n-1-i) < ... < z(n-1)) for ordering k.
+        # w[i, k, x] = Pr(z0 < z1 < ... < z(i) < x) for ordering k.
+        v = np.empty((n - 1, m, self.num_bins))
+        w = np.empty((n - 1, m, self.num_bins))
+        v[0] = 1 - self.get_cdf(descend_lists[:, n - 1])
+        w[0] = self.get_cdf(descend_lists[:, 0]) - q[:, 0, :]
         for idx in xrange(1, n - 1, 1):
-            # Matrix v.
-            # Calculating v[idx,:] given v[idx-1,:].
-            t = self.qdistr[descend_list[n - 1 - idx], :] * v[idx - 1, :]
-            t = t[::-1]
-            t = np.cumsum(t)
-            # Shift.
-            t = self.shift_vector(t)
-            v[idx,:] = t[::-1]
-
-            # Matrix w.
-            # Calculating w[idx,:] given w[idx-1,:].
-            t = self.qdistr[descend_list[idx], :] * w[idx - 1, :]
-            t = np.cumsum(t)
-            t = self.shift_vector(t)
-            w[idx,:] = t
-        # Updating distributions.
-        # Update first distributions.
-        idx = descend_list[0]
-        q = self.qdistr[idx,:]
-        q_prime = q * v[-1, :]
-        # Annealing.
-        if annealing_type == 'before_normalization_uniform':
-            self.qdistr[idx,:] = (1.0/factorial) * (1 - self.alpha) * q + \
-                                                               self.alpha * q_prime
-            self.qdistr[idx,:] = self.qdistr[idx,:] / np.sum(self.qdistr[idx,:])
-        elif annealing_type == 'after_normalization':
-            q_prime = q_prime / np.sum(q_prime)
-            self.qdistr[idx,:] = (1 - self.alpha) * q + self.alpha * q_prime
-        elif annealing_type == 'before_normalization_gauss':
-            ww = v[-1, :]
-            self.qdistr[idx,:] = (1 - self.alpha) * q *(1 - ww) + \
-                                      self.alpha * q * ww
-            self.qdistr[idx,:] = self.qdistr[idx,:] / np.sum(self.qdistr[idx,:])
-        else:
-            # Should not happen.
-            raise Exception("Error: annealing type is not known.")
-        # Update last distributions.
-        idx = descend_list[-1]
-        q = self.qdistr[idx,:]
-        q_prime = q * w[-1, :]
+            # Calculating v[idx] given v[idx-1], shifted cumulative sum
+            # from the right.
+            t = np.cumsum((q[:, n - 1 - idx, :] * v[idx - 1])[:, ::-1], 1)
+            v[idx, :, :-1] = t[:, -2::-1]
+            v[idx, :, -1] = 0
+            # Calculating w[idx] given w[idx-1], shifted cumulative sum
+            # from the left.
+            t = np.cumsum(q[:, idx, :] * w[idx - 1], 1)
+            w[idx, :, 1:] = t[:, :-1]
+            w[idx, :, 0] = 0
+        # ww[k, i, :] is probability of the ordering k given quality of item
+        # descend_lists[k, i].
+        ww = np.empty((m, n, self.num_bins))
+        ww[:, 0, :] = v[-1]
+        ww[:, -1, :] = w[-1]
+        for i in xrange(1, n - 1, 1):
+            ww[:, i, :] = w[i - 1] * v[-(i + 1)]
         # Annealing.
         if annealing_type == 'before_normalization_uniform':
-            self.qdistr[idx,:] = (1.0/factorial) * (1 - self.alpha) * q + \
-                                                               self.alpha * q_prime
-            self.qdistr[idx,:] = self.qdistr[idx,:] / np.sum(self.qdistr[idx,:])
+            q_new = (1.0 / factorial) * (1 - alpha) * q + alpha * q * ww
+            q_new /= np.sum(q_new, 2)[:, :, np.newaxis]
         elif annealing_type == 'after_normalization':
-            q_prime = q_prime / np.sum(q_prime)
-            self.qdistr[idx,:] = (1 - self.alpha) * q + self.alpha * q_prime
+            q_prime = q * ww
+            total = np.sum(q_prime, 2)[:, :, np.newaxis]
+            # If the ordering is impossible given current distributions
+            # then q is left as it is instead of becoming nan.
+            q_prime = np.where(total > 0, q_prime / np.where(total > 0, total, 1),
+                               q)
+            q_new = (1 - alpha) * q + alpha * q_prime
         elif annealing_type == 'before_normalization_gauss':
-            ww = w[-1, :]
-            self.qdistr[idx,:] = (1 - self.alpha) * q *(1 - ww) + \
-                                      self.alpha * q * ww
-            self.qdistr[idx,:] = self.qdistr[idx,:] / np.sum(self.qdistr[idx,:])
+            q_new = (1 - alpha) * q * (1 - ww) + alpha * q * ww
+            q_new /= np.sum(q_new, 2)[:, :, np.newaxis]
         else:
             # Should not happen.
             raise Exception("Error: annealing type is not known.")
+        self.qdistr[descend_lists, :] = q_new
+        self.invalidate_cdf(descend_lists.ravel())
 
-        # Update the rest of distributions.
-        for i in range(1, n - 1, 1):
-            idx = descend_list[i]
-            q = self.qdistr[idx,:]
-            q_prime = q * w[i - 1, :] * v[-(i+1), :]
-            # Annealing.
-            if annealing_type == 'before_normalization_uniform':
-                self.qdistr[idx,:] = (1.0/factorial) * (1 - self.alpha) * q + \
-                                                               self.alpha * q_prime
-                self.qdistr[idx,:] = self.qdistr[idx,:] / np.sum(self.qdistr[idx,:])
-            elif annealing_type == 'after_normalization':
-                q_prime = q_prime / np.sum(q_prime)
-                self.qdistr[idx,:] = (1 - self.alpha) * q + self.alpha * q_prime
-            elif annealing_type == 'before_normalization_gauss':
-                ww = w[i - 1, :] * v[-(i+1), :]
-                self.qdistr[idx,:] = (1 - self.alpha) * q *(1 - ww) + \
-                                          self.alpha * q * ww
-                self.qdistr[idx,:] = self.qdistr[idx,:] / np.sum(self.qdistr[idx,:])
-            else:
-                # Should not happen.
-                raise Exception("Error: annealing type is not known.")
+    def update_batch(self, sorted_items_list, alphas=None,
+                     annealing_type='before_normalization_uniform'):
+        """ Updates quality distributions given a list of orderings, the
+        result is the same as calling update on each ordering in turn.
+        Consecutive orderings of the same length which do not share items
+        are processed together by n_comparisons_update_batch.
+        Nothing is returned, use get_result to obtain items parameters.
 
-        # Update id2rank and rank2id vectors.
-        self.rank2id, self.id2rank = self.compute_ranks(self.qdistr)
+        Arguments:
+            - sorted_items_list is a list of orderings, each of them is like
+            sorted_items in update.
+            - alphas is a list with annealing coefficient for each ordering,
+            if it is None then self.alpha is used.
+        """
+        if alphas is None:
+            alphas = [self.alpha] * len(sorted_items_list)
+        batch, batch_alphas, batch_items = [], [], set()
+        changed = set()
+        for sorted_items, alpha in zip(sorted_items_list, alphas):
+            sorted_ids = self.get_indices(sorted_items)
+            if (len(batch) > 0 and (len(sorted_ids) != len(batch[0]) or
+                not batch_items.isdisjoint(sorted_ids))):
+                self.n_comparisons_update_batch(batch, batch_alphas,
+                                                annealing_type)
+                batch, batch_alphas, batch_items = [], [], set()
+            batch.append(sorted_ids)
+            batch_alphas.append(alpha)
+            batch_items.update(sorted_ids)
+            changed.update(sorted_ids)
+        if len(batch) > 0:
+            self.n_comparisons_update_batch(batch, batch_alphas,
+                                            annealing_type)
+        if len(changed) > 0:
+            self.update_ranks(list(changed))
 
-    def sample(self, black_items=None):
+    def sample(self, black_items=None, rank_window=None):
         """ Returns two items to compare. If there is no two items to sample
         from then None is returned.
         Sampling by loss-driven comparison algorithm.
         black_items cannot be sampled.
+        If rank_window is not None then only pairs of items which are at most
+        rank_window apart in rank are considered (see sample_in_rank_window),
+        it must be at least 1.
         """
+        if not rank_window is None and rank_window < 1:
+            raise ValueError("rank_window must be at least 1, not %r" % rank_window)
         indices = range(self.num_items)
         if (not black_items == None) and (not len(black_items) == 0):
-            indices = [x for x in indices if not x in black_items]
+            allowed = np.ones(self.num_items, dtype=bool)
+            allowed[list(black_items)] = False
+            indices = np.nonzero(allowed)[0]
         if len(indices) < 2:
             return None
+        if not rank_window is None and len(indices) > rank_window + 1:
+            return self.sample_in_rank_window(indices, rank_window)
         # l is len(indices)^2 array; l[idx] is expected loss of for items with ids
         # idx/len(indices) and idx%len(indices)
-        l = np.zeros(len(indices) ** 2)
-        for i in xrange(len(indices)):
-            for j in xrange(len(indices)):
-                    # We are choosing pairs (i, j) such that p(i) < p(j)
-                    ii = indices[i]
-                    jj = indices[j]
-                    if self.id2rank[ii] < self.id2rank[jj]:
-                        l[i * len(indices) + j] = self.get_expected_loss(ii, jj)
-                    else:
-                        l[i * len(indices) + j] = 0
+        # We are choosing pairs (i, j) such that p(i) < p(j)
+        ranks = self.id2rank[indices]
+        l = np.where(ranks[:, np.newaxis] < ranks[np.newaxis, :],
+                     self.get_expected_loss_matrix(indices, indices), 0)
+        l = l.ravel()
         # normalization
         l /= l.sum()
 
@@ -447,6 +725,49 @@ class Rank:
             raise Exception('There is an error in sampling!')
         return ii, jj
 
+    def sample_in_rank_window(self, indices, rank_window):
+        """ Same as sample, but only pairs of items from indices which are at
+        most rank_window positions apart in the order of indices by rank are
+        considered. Losses are computed for n * rank_window pairs instead of
+        n^2 pairs, where n is len(indices).
+
+        Error bound: pairs are sampled with probability proportional to their
+        expected loss, so the total variation distance between this sampler
+        and the exact one is (loss of dropped pairs) / (loss of all pairs).
+        Expected loss of a pair is at most its miss-rank probability, which
+        for gaussian-like distributions with stdevs at most s and means mu_i
+        and mu_j is about Phi(-|mu_i - mu_j| / (sqrt(2) * s)). Items are
+        ordered by mean, so if means of items rank_window + 1 positions
+        apart always differ by at least d, dropped loss is at most
+        n^2 / 2 * Phi(-d / (sqrt(2) * s)); it vanishes once
+        rank_window * (spacing of means) is a few stdevs.
+        """
+        if rank_window < 1:
+            raise ValueError("rank_window must be at least 1, not %r" % rank_window)
+        # order[a] is an item of a-th smallest rank among indices.
+        order = np.asarray(indices)[np.argsort(self.id2rank[indices])]
+        n = len(order)
+        cdf = self.get_cdf(order)
+        qdistr = self.qdistr[order, :]
+        # l[a, d - 1] is expected loss for items order[a] and order[a + d].
+        l = np.zeros((n, rank_window))
+        for d in xrange(1, rank_window + 1, 1):
+            l[:n - d, d - 1] = np.sum(cdf[:-d] * qdistr[d:], 1)
+        if not self.cost_obj == None:
+            cost = self.get_cost_vector()[order]
+            for d in xrange(1, rank_window + 1, 1):
+                l[:n - d, d - 1] *= np.abs(cost[:-d] - cost[d:])
+        l = l.ravel()
+        # normalization
+        l /= l.sum()
+
+        # randomly choosing a pair
+        cs = l.cumsum()
+        rn = np.random.uniform()
+        idx = cs.searchsorted(rn)
+        a, d = idx / rank_window, idx % rank_window + 1
+        return order[a], order[a + d]
+
     def sample_n_items(self, n):
         items = set()
         while True:
@@ -459,21 +780,23 @@ class Rank:
                 items.remove(i if random.random() < 0.5 else j)
                 return list(items)
 
-    def sample_item(self, old_items, black_items, sample_one=True ):
+    def sample_item(self, old_items, black_items, sample_one=True,
+                    rank_window=None):
         """ Method samples an item given items the user received before.
         If sample_one is true then if old_items is None or empty then method
         returns one item, otherwise it returns two itmes.
         black_items is a list with items which should not be sampled.
         If it is impossible to sample an item then None is returned.
+        rank_window is passed to sample (used if old_items is empty).
         """
         if black_items == None:
             black_items = []
         if old_items == None or len(old_items) == 0:
             if len(black_items) == 0:
-                l = self.sample()
+                l = self.sample(rank_window=rank_window)
             else:
-                ids = [self.orig_items_id.index(x) for x in black_items]
-                l = self.sample(ids)
+                ids = self.get_indices(black_items)
+                l = self.sample(ids, rank_window=rank_window)
             # If we need two elements.
             if not sample_one:
                 if l == None:
@@ -488,28 +811,25 @@ class Rank:
                 return None
             if len(self.orig_items_id) == 0:
                 return None
+            black_items = set(black_items)
             item = [x for x in self.orig_items_id if not x in black_items]
             return item[0]
 
-        taken_ids = [idx for idx in range(self.num_items) if \
-                        self.orig_items_id[idx] in old_items]
-        free_ids = [idx for idx in range(self.num_items) if \
-                        (not self.orig_items_id[idx] in old_items and
-                         not self.orig_items_id[idx] in black_items)]
+        taken = self.get_mask(old_items)
+        taken_ids = np.nonzero(taken)[0]
+        free_ids = np.nonzero(~taken & ~self.get_mask(black_items))[0]
         # If there are no items to pick from then return None.
         if len(free_ids) == 0:
             return None
         # l[idx] is expected loss of for items with ids
         # idx/len(taken_ids) and idx%len(taken_ids)
-        l = np.zeros(len(taken_ids) * len(free_ids))
-        for i in xrange(len(taken_ids)):
-            for j in xrange(len(free_ids)):
-                    ii = taken_ids[i]
-                    jj = free_ids[j]
-                    if self.id2rank[ii] < self.id2rank[jj]:
-                        l[i * len(free_ids) + j] = self.get_expected_loss(ii, jj)
-                    else:
-                        l[i * len(free_ids) + j] = self.get_expected_loss(jj, ii)
+        # Loss of a pair is computed with the item of smaller rank first.
+        ranks_taken = self.id2rank[taken_ids]
+        ranks_free = self.id2rank[free_ids]
+        l = np.where(ranks_taken[:, np.newaxis] < ranks_free[np.newaxis, :],
+                     self.get_expected_loss_matrix(taken_ids, free_ids),
+                     self.get_expected_loss_matrix(free_ids, taken_ids).T)
+        l = l.ravel()
         # normalization
         #print l
         l /= l.sum()
@@ -548,12 +868,38 @@ class Rank:
     def get_cost(self, i, k, id2rank):
         return self.cost_obj.calculate(i, k, id2rank)
 
+    def get_cost_vector(self):
+        """ Returns vector c such that c[i] is cost of the item with id i.
+        """
+        return self.cost_obj.calculate_vector(self.k, self.id2rank)
+
+    def get_expected_loss_matrix(self, rows, cols):
+        """ Returns matrix l such that l[a, b] is expected loss
+        get_expected_loss(rows[a], cols[b]), all pairs are computed at once.
+        """
+        prob = self.get_missrank_prob_matrix(rows, cols)
+        if self.cost_obj == None:
+            return prob
+        cost = self.get_cost_vector()
+        c_rows = cost[rows]
+        c_cols = cost[cols]
+        return np.abs(c_rows[:, np.newaxis] - c_cols[np.newaxis, :]) * prob
+
+    def get_missrank_prob_matrix(self, rows, cols):
+        """ Returns matrix p such that p[a, b] is
+        get_missrank_prob(rows[a], cols[b]), i.e. probability that
+        r(rows[a]) > r(cols[b]).
+        All the probabilities are obtained by one matrix product with
+        cached cumulative distributions.
+        """
+        return np.dot(self.get_cdf(rows), self.qdistr[cols, :].T)
+
     def get_missrank_prob(self, i, k):
         """ Method returns probability that r(i) > r(k) where r(i) is a rank
         of an item with id i.
         """
         q_k = self.qdistr[k, :]
-        Q_i = np.cumsum(self.qdistr[i, :])
+        Q_i = self.get_cdf([i])[0]
         prob = np.dot(q_k, Q_i)
         return prob
 
@@ -580,12 +926,10 @@ class Rank:
         """ Method returns array w such that w[2*i], w[2*i+1] are mean and
         standard deviation of quality distribution of item i (self.qdist[i])
         """
+        mean, stdev = self.compute_moments()
         w = np.zeros(2 * self.num_items)
-        val = range(self.num_bins)
-        for i in xrange(self.num_items):
-            p = self.qdistr[i,:]
-            w[2 * i] = np.sum(p * val)
-            w[2 * i + 1] = np.sqrt(np.sum(p * (val - w[2 * i]) ** 2))
+        w[0::2] = mean
+        w[1::2] = stdev
         return w
 
     def restore_qdistr_from_parameters(self, w):
@@ -593,94 +937,103 @@ class Rank:
         get_qdistr_parameters: w such that w[2*i], w[2*i+1] are mean and
         standard deviation of quality distribution of item i
         """
-        self.qdist = np.zeros((self.num_items, self.num_bins))
-        y = range(self.num_bins)
-        for i in xrange(self.num_items):
-            mean = w[2 * i]
-            std = w[2 * i + 1]
-            self.qdistr[i, :] = self.get_normal_vector(self.num_bins, mean, std)
-            #self.qdistr[i,:] = scipy.stats.distributions.norm.pdf(y, loc=mean,
-            #                                                    scale=std)
-            if np.sum(self.qdistr[i,:]) == 0:
-                print 'ERROR, sum should not be zero !!!'
-        # Normalization.
-        #self.qdistr = self.qdistr / np.sum(self.qdistr, 1) [:, np.newaxis]
+        w = np.asarray(w, dtype=np.float64) / self.bin_width
+        self.qdistr = self.get_normal_matrix(self.num_bins, w[0::2], w[1::2],
+                                             dtype=self.dtype)
+        #self.qdistr[i,:] = scipy.stats.distributions.norm.pdf(y, loc=mean,
+        #                                                    scale=std)
+        if np.any(np.sum(self.qdistr, 1) == 0):
+            print 'ERROR, sum should not be zero !!!'
+        self.invalidate_cdf()
+        # Ranks have to reflect the restored distributions.
+        self.init_ranks()
 
     def evaluate_ordering(self, ordering):
         """ rank(oredring[i]) > rank(ordering[j]) for i < j
         (Worst to Best)
         Function, returns average probability of error.
         """
-        n = len(ordering)
-        if n <= 1:
-            return 0
+        return self.evaluate_orderings([ordering])[0]
+
+    def evaluate_orderings(self, orderings):
+        """ Returns an array with evaluate_ordering of each ordering of
+        orderings. Probabilities of error of all pairs of items of an
+        ordering are obtained at once (see get_missrank_prob_matrix), and
+        cumulative distributions are shared by all the orderings.
+        """
         # Below ordering is evaluated using "incremental" way.
         # Incremental type of ordering evaluation is when for each
-        # entity e in ordering (starting from 2nd one) we compute
-        # error_e = 1 - 2*max(Pr(error)) and total evaluation is
-        # a sum of all error_e.
-        # max(Pr(error)) is a maxmum error that the user made when comparing
-        # entity e.
-        val = 0.0
-        for i in xrange(0, n, 1):
-            ii = self.orig_items_id.index(ordering[i])
-            l1 = [self.get_missrank_prob(self.orig_items_id.index(ordering[j]),
-                                               ii) for j in xrange(i + 1, n, 1)]
-            l2 = [self.get_missrank_prob(ii,
-                   self.orig_items_id.index(ordering[j])) for j in xrange(0, i, 1)]
-            #pr_error = 0
-            #if len(l1) != 0:
-            #    pr_error = max(l1)
-            #if len(l2) != 0:
-            #    pr_error = max([max(l2), pr_error])
-            #val += 1 - 2 * pr_error
-            l1.extend(l2)
-            if len(l1) == 0:
+        # entity e in ordering we compute error_e = 1 - mean(Pr(error))
+        # and total evaluation is a sum of all error_e.
+        # Pr(error) are probabilities of errors that the user made when
+        # comparing entity e with the other entities.
+        result = np.zeros(len(orderings))
+        for k, ordering in enumerate(orderings):
+            n = len(ordering)
+            if n <= 1:
                 continue
-            val += 1 - np.mean(l1)
-        return val
+            idxs = self.get_indices(ordering)
+            # p[i, j] is the probability that r(ordering[i]) > r(ordering[j]),
+            # so p[j, i] is the probability of error for i < j.
+            p = self.get_missrank_prob_matrix(idxs, idxs)
+            # Each pair i < j counts for both entities.
+            if not self.triu_indices.has_key(n):
+                self.triu_indices[n] = np.triu_indices(n, 1)
+            pr_error = np.sum(p.T[self.triu_indices[n]])
+            result[k] = n - 2 * pr_error / (n - 1)
+        return result
+
+    def get_dirichlet_parameters(self, ordering):
+        """ Returns parameters alpha, beta of the Beta distribution of the
+        probability that the user who made the ordering (Worst to Best)
+        compares a pair of items correctly.
+        Each pair of items adds to alpha the confidence that the pair is
+        ordered correctly, and to beta the confidence that it is not.
+        """
+        n = len(ordering)
+        idxs = self.get_indices(ordering)
+        # p[i, j] is the probability that r(ordering[i]) > r(ordering[j]).
+        p = self.get_missrank_prob_matrix(idxs, idxs)
+        # q[i, j] is a probability that comparison of ordering[i] and
+        # ordering[j] is True, only pairs i < j are needed.
+        if not self.triu_indices.has_key(n):
+            self.triu_indices[n] = np.triu_indices(n, 1)
+        q = 1 - p.T[self.triu_indices[n]]
+        # alpha is a number of "Truth"
+        # beta is a number of "False"
+        alpha = 0.01 + 2 * np.sum(q[q > 0.5] - 0.5)
+        beta = 0.01 + 2 * np.sum(0.5 - q[q <= 0.5])
+        return alpha, beta
+
+    def evaluate_orderings_using_dirichlet(self, orderings, perc=0.9):
+        """ Returns an array with the quality of each ordering (Worst to
+        Best) of orderings: the value which the probability q that the user
+        compares a pair of items correctly exceeds with probability perc
+        (i.e. the (1 - perc)-quantile of q), where q has the Beta
+        distribution given by get_dirichlet_parameters restricted to
+        [DIRICHLET_MIN_Q, 1 - DIRICHLET_MIN_Q]. With few comparisons the
+        parameters are small and the density is unbounded at 0 and 1, the
+        restriction keeps such orderings away from quality 0 or 1.
+        Orderings of less than two items have quality 0.
+        Quantiles of all the orderings are computed together.
+        """
+        result = np.zeros(len(orderings))
+        idxs = [i for i, ordering in enumerate(orderings) if len(ordering) > 1]
+        if len(idxs) == 0:
+            return result
+        params = np.array([self.get_dirichlet_parameters(orderings[i])
+                           for i in idxs])
+        result[idxs] = beta_ppf(1 - perc, params[:, 0], params[:, 1],
+                                lo=DIRICHLET_MIN_Q, hi=1 - DIRICHLET_MIN_Q)
+        return result
 
     def evaluate_ordering_using_dirichlet(self, ordering):
         """ rank(oredring[i]) > rank(ordering[j]) for i < j
         (Worst to Best).
+        Returns the quality of the ordering, see
+        evaluate_orderings_using_dirichlet.
         """
-        if len(ordering) <= 1:
-            return 0
-        # alpha is a number of "Truth"
-        # beta is a number of "False"
-        alpha, beta = 0.01, 0.01
-        for i in xrange(len(ordering)):
-            for j in xrange(i + 1, len(ordering), 1):
-                item_i = self.orig_items_id.index(ordering[i])
-                item_j = self.orig_items_id.index(ordering[j])
-                # q is a probability that comparison is True
-                #q = 1 - self.get_missrank_prob(item_i, item_j)
-                q = 1 - self.get_missrank_prob(item_j, item_i)
-                # Update alpha and beta.
-                if q > 0.5:
-                    alpha += 2 * (q - 0.5)
-                else:
-                    beta += 2 * (0.5 - q)
-        # Okay, alpha and beta are computed.
-        # Let's q is a probability that user says True.
-        # The quality of the ordering is 90-th percentile, so we need to compute it.
-        perc = 0.9
-        # First, numerically compute unnormalised probability mass function of q
-        delta = 0.001
-        x = np.arange(0 + delta, 1, delta)
-        #print 'alpha', alpha
-        #print 'beta', beta
-        y = x ** (alpha - 1) * (1 - x) ** (beta - 1)
-        # Integral approximation based on trapezoidal rule.
-        y1 = y[:-1]
-        y2 = y[1:]
-        integral_vec = (y2 + y1) / 2 * delta
-        integral = np.sum(integral_vec)
-        cumsum = np.cumsum(integral_vec)
-        threshold = (1 - perc) * integral
-        idx = cumsum.searchsorted(threshold)
-        val = idx * delta
-        return val
+        return self.evaluate_orderings_using_dirichlet([ordering])[0]
 
     def sort_items_truthfully(self, items):
         """ Method is for testing purposes.
@@ -689,8 +1042,7 @@ class Rank:
         if i > j.
         #TODO(michael): check this function in case of use
         """
-        items_ids = [idx for idx in range(self.num_items) if \
-                        self.orig_items_id[idx] in items]
+        items_ids = np.nonzero(self.get_mask(items))[0]
         values = np.array(self.quality_true)[items_ids]
         idx = np.argsort(values)
         return [self.orig_items_id[x] for x in np.array(items_ids)[idx]]
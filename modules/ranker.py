@@ -1,16 +1,127 @@
 #!/usr/bin/env python
 # coding: utf8
 from gluon import *
+from gluon import portalocker
 from rank import Rank
 from rank import Cost
 import util
+import comparison_log
 from datetime import datetime
 import numpy as np
 import random
+import math
+import os
+import collections
+import logging
+import multiprocessing
+import threading
 
 NUM_BINS = 2001
 AVRG = NUM_BINS / 2
 STDEV = NUM_BINS / 8
+# Minimum number of bins per standard deviation of the narrowest
+# distribution when sampling items in get_item. Sampling only needs rough
+# probabilities of mistakes, so early in a venue, when distributions are
+# wide, a coarse grid over the same range of qualities is enough.
+# Qualities stored in the db always use NUM_BINS.
+SAMPLING_BINS_PER_STDEV = 20
+
+# When a user gets the first item to rank, pairs of submissions are
+# sampled only among submissions which are at most SAMPLING_RANK_WINDOW
+# apart in rank (see Rank.sample_in_rank_window), so large venues do not
+# need losses for all pairs of submissions.
+SAMPLING_RANK_WINDOW = 50
+
+# Maximum number of venues whose ranking state is cached by the process
+# (see VenueCache).
+VENUE_CACHE_SIZE = 20
+
+# Number of comparison rows read from the db at a time when replaying
+# all the comparisons of a venue (see iter_comparisons).
+COMPARISON_PAGE_SIZE = 1000
+
+# Whether comparisons are replayed from the comparison log of the venue
+# (see comparison_log), rather than read from the db.
+USE_COMPARISON_LOG = True
+
+# The reputation system of a venue stops iterating when reputations and
+# submission percentiles change on average by at most REP_SYS_TOLERANCE in
+# an iteration, or after REP_SYS_MAX_ITERATIONS iterations.
+REP_SYS_TOLERANCE = 0.01
+REP_SYS_MAX_ITERATIONS = 4
+
+# Number of independent chains of the "small alpha" reputation system whose
+# distributions are averaged (see run_reputation_system).
+REP_SYS_NUM_CHAINS = 4
+
+# Long computations report progress (see jobs.run_job) after every
+# PROGRESS_STEP comparisons or reviewers.
+PROGRESS_STEP = 1000
+
+def get_bin_width(num_bins):
+    """ Returns the width of a bin such that num_bins bins cover the same
+    range of qualities as NUM_BINS bins.
+    """
+    return (NUM_BINS - 1) / float(num_bins - 1)
+
+def get_sampling_num_bins(qdistr_param):
+    """ Returns number of bins (at most NUM_BINS) such that the narrowest
+    distribution in qdistr_param spans SAMPLING_BINS_PER_STDEV bins per
+    standard deviation.
+    """
+    min_stdev = min(qdistr_param[1::2])
+    width = max(1.0, min_stdev / float(SAMPLING_BINS_PER_STDEV))
+    return min(NUM_BINS, int(math.ceil((NUM_BINS - 1) / width)) + 1)
+
+def uses_datastore(db):
+    """ Returns True if db is the Google datastore, which does not support
+    joins, GROUP BY and raw SQL. """
+    return db._dbname == 'google:datastore'
+
+def bulk_update(db, table, venue_id, field_names, rows):
+    """ Updates records of table which belong to venue venue_id, in the
+    current transaction.
+    rows is a list of tuples (id, value_1, ..., value_k) where value_i is a
+    new value of field field_names[i - 1] for the record with id.
+    The UPDATE statements are built by the DAL and executed directly, so
+    that records are neither read nor checked by the DAL one by one; on
+    the Google datastore records are updated through the DAL.
+    Returns the number of rows written.
+    """
+    for r in rows:
+        query = (table._id == r[0]) & (table.venue_id == venue_id)
+        fields = dict(zip(field_names, r[1:]))
+        if uses_datastore(db):
+            db(query).update(**fields)
+        else:
+            db.executesql(db(query)._update(**fields))
+    return len(rows)
+
+def bulk_update_or_insert_by_user(db, table, venue_id, records):
+    """ Writes records (dictionaries with field values, including 'user')
+    for venue venue_id to table, which has a record per user and venue.
+    Existing records are read with one query and updated by bulk_update,
+    the rest of records are inserted.
+    Returns the number of rows written.
+    """
+    if len(records) == 0:
+        return 0
+    rows = db(table.venue_id == venue_id).select(table._id, table.user)
+    user_to_id = dict((r.user, r[table._id.name]) for r in rows)
+    field_names = [f for f in records[0] if f != 'user']
+    updates, inserts = [], []
+    for rec in records:
+        if rec['user'] in user_to_id:
+            updates.append(tuple([user_to_id[rec['user']]] +
+                                 [rec[f] for f in field_names]))
+        else:
+            rec = dict(rec)
+            rec['venue_id'] = venue_id
+            inserts.append(rec)
+    bulk_update(db, table, venue_id, field_names, updates)
+    if len(inserts) > 0:
+        table.bulk_insert(inserts)
+    return len(records)
 
 def get_all_items_qdistr_param_and_users(db, venue_id):
     """ Returns a tuple (items, qdistr_param) where:
@@ -38,23 +149,168 @@ def get_all_items_qdistr_param_and_users(db, venue_id):
     # Ok, items, qdistr_param  and users_list are filled.
     return items, qdistr_param, users_list
 
+class VenueState(object):
+    """ Ranking state of a venue as read from the db: submissions, their
+    qualities and submitters.
+    """
+    __slots__ = ('token', 'items', 'qdistr_param', 'users_list', 'item_idx',
+                 'rankobj')
+
+    def __init__(self, token, items, qdistr_param, users_list):
+        self.token = token
+        self.items = items
+        self.qdistr_param = qdistr_param
+        self.users_list = users_list
+        self.item_idx = dict((x, i) for i, x in enumerate(items))
+        # Rank object for all the items, it is built on demand.
+        self.rankobj = None
+
+    def get_rank(self, keep=False):
+        """ Returns Rank object for all items of the venue, if keep is True
+        then it is kept for further calls (it holds dense distributions).
+        """
+        rankobj = self.rankobj
+        if rankobj is None:
+            rankobj = Rank.from_qdistr_param(self.items, self.qdistr_param,
+                                             cost_obj=None)
+            if keep:
+                self.rankobj = rankobj
+        return rankobj
+
+
+class VenueCache(object):
+    """ Process-level cache of ranking state of venues, it is shared by
+    requests served by the process.
+    A cached state is valid while the venue has the same rank_version
+    (see bump_rank_version) and the same number of submissions. At most
+    max_size venues are kept, least recently used venues are evicted first.
+    """
+    def __init__(self, max_size=VENUE_CACHE_SIZE, keep_qdistr=False):
+        self.max_size = max_size
+        self.keep_qdistr = keep_qdistr
+        self.states = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_token(self, db, venue_id):
+        venue = db(db.venue.id == venue_id).select(
+            db.venue.rank_version).first()
+        version = None if venue is None else (venue.rank_version or 0)
+        return version, db(db.submission.venue_id == venue_id).count()
+
+    def get(self, db, venue_id):
+        """ Returns VenueState of venue venue_id, the db is read only if the
+        cached state is outdated.
+        """
+        token = self.get_token(db, venue_id)
+        with self.lock:
+            state = self.states.pop(venue_id, None)
+            if state is not None and state.token == token:
+                self.hits += 1
+                self.states[venue_id] = state
+                return state
+            self.misses += 1
+        items, qdistr_param, users_list = get_all_items_qdistr_param_and_users(
+                                                                db, venue_id)
+        state = VenueState(token, items, qdistr_param, users_list)
+        with self.lock:
+            self.states[venue_id] = state
+            while len(self.states) > self.max_size:
+                self.states.popitem(last=False)
+        return state
+
+    def get_rank(self, db, venue_id):
+        """ Returns Rank object for all submissions of venue venue_id. """
+        return self.get(db, venue_id).get_rank(keep=self.keep_qdistr)
+
+    def update(self, venue_id, old_token, new_token, result):
+        """ Writes through qualities of items changed from old_token to
+        new_token, result is like in Rank.update. If the cached state is not
+        at old_token then somebody else changed the venue and the state is
+        dropped.
+        """
+        with self.lock:
+            state = self.states.get(venue_id)
+            if state is None:
+                return
+            if state.token != old_token:
+                del self.states[venue_id]
+                return
+            # States are shared, so the changed state is a new object.
+            qdistr_param = list(state.qdistr_param)
+            for x, (perc, avrg, stdev) in result.iteritems():
+                idx = state.item_idx.get(x)
+                if idx is not None:
+                    qdistr_param[2 * idx] = avrg
+                    qdistr_param[2 * idx + 1] = stdev
+            self.states[venue_id] = VenueState(new_token, state.items,
+                                               qdistr_param, state.users_list)
+
+    def invalidate(self, venue_id):
+        """ Drops the cached state of venue venue_id. """
+        with self.lock:
+            self.states.pop(venue_id, None)
+
+    def stats(self):
+        """ Returns dictionary with numbers of hits, misses and cached venues.
+        """
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        size=len(self.states))
+
+venue_cache = VenueCache()
+
+def bump_rank_version(db, venue_id, **fields):
+    """ Increments rank_version of the venue, which invalidates its cached
+    state, and updates its fields. It has to be called whenever qualities
+    of submissions of the venue are written.
+    Returns the new rank_version.
+    """
+    db(db.venue.id == venue_id).update(
+        rank_version = db.venue.rank_version.coalesce_zero() + 1, **fields)
+    # The row is locked by the update, so this is our own version.
+    return db(db.venue.id == venue_id).select(db.venue.rank_version).first().rank_version
+
 def get_qdistr_param(db, venue_id, items_id):
+    """ Returns list qdistr_param such that qdistr_param[2*i] and
+    qdistr_param[2*i + 1] are mean and stdev of submission items_id[i].
+    Qualities of all the submissions are fetched with one query.
+    """
     if items_id == None:
         return None
+    rows = db((db.submission.venue_id == venue_id) &
+              (db.submission.id.belongs(items_id))).select(db.submission.id,
+              db.submission.quality, db.submission.error)
+    quality_d = dict((r.id, (r.quality, r.error)) for r in rows)
     qdistr_param = []
     for x in items_id:
-        quality_row = db((db.submission.venue_id == venue_id) &
-                  (db.submission.id == x)).select(db.submission.quality,
-                  db.submission.error).first()
-        if (quality_row is None or quality_row.quality is None or
-	    quality_row.error is None):
+        quality, error = quality_d.get(x, (None, None))
+        if quality is None or error is None:
             qdistr_param.append(AVRG)
             qdistr_param.append(STDEV)
         else:
-            qdistr_param.append(quality_row.quality)
-            qdistr_param.append(quality_row.error)
+            qdistr_param.append(quality)
+            qdistr_param.append(error)
     return qdistr_param
 
+def get_assignment_counts(db, venue_id):
+    """ Returns dictionary d such that d[subm_id] is how many times
+    submission subm_id was assigned as a task (declined tasks included).
+    Submissions which were never assigned are not in d.
+    All counts are obtained with one query (on the Google datastore, which
+    has no GROUP BY, tasks are counted one by one).
+    """
+    if uses_datastore(db):
+        counts = {}
+        for r in db(db.task.venue_id == venue_id).select(db.task.submission_id):
+            counts[r.submission_id] = counts.get(r.submission_id, 0) + 1
+        return counts
+    count = db.task.id.count()
+    rows = db(db.task.venue_id == venue_id).select(db.task.submission_id, count,
+                                                   groupby=db.task.submission_id)
+    return dict((r.task.submission_id, r[count]) for r in rows)
+
 def get_init_average_stdev():
     """ Method returns tuple with average and stdev for initializing
     field in table quality.
@@ -86,7 +342,8 @@ def get_item(db, venue_id, user, old_items,
     """
     if old_items is None:
         old_items = []
-    items, qdistr_param, _ = get_all_items_qdistr_param_and_users(db, venue_id)
+    state = venue_cache.get(db, venue_id)
+    items, qdistr_param = state.items, state.qdistr_param
     # If items is None then some submission does not have qualities yet,
     # we need to know qualities of for all submission to correctly choose an
     # item.
@@ -105,14 +362,13 @@ def get_item(db, venue_id, user, old_items,
     else:
         users_submission_ids = []
     # Counting how many times each submission was assigned.
-    # TODO(michael): use the field in the submissions, once we confirm that this works.
+    assignment_counts = get_assignment_counts(db, venue_id)
+    excluded_items = set(users_submission_ids)
+    excluded_items.update(old_items)
     frequency = []
     for subm_id in items:
-        if (subm_id not in users_submission_ids and
-            subm_id not in old_items):
-            count = db((db.task.submission_id == subm_id) &
-                       (db.task.venue_id == venue_id)).count()
-            frequency.append((subm_id, count))
+        if subm_id not in excluded_items:
+            frequency.append((subm_id, assignment_counts.get(subm_id, 0)))
     # Do we have items to sample from?
     if len(frequency) == 0:
         return None
@@ -127,12 +383,15 @@ def get_item(db, venue_id, user, old_items,
     # Fetching quality distribution parameters.
     qdistr_param_pool = []
     for subm_id in pool_items:
-        idx = items.index(subm_id)
+        idx = state.item_idx[subm_id]
         qdistr_param_pool.append(qdistr_param[2 * idx])
         qdistr_param_pool.append(qdistr_param[2 * idx + 1])
+    num_bins = get_sampling_num_bins(qdistr_param_pool)
     rankobj = Rank.from_qdistr_param(pool_items, qdistr_param_pool,
-                                     cost_obj=cost_obj)
-    return rankobj.sample_item(old_items, black_items=[])
+                                     cost_obj=cost_obj, num_bins=num_bins,
+                                     bin_width=get_bin_width(num_bins))
+    return rankobj.sample_item(old_items, black_items=[],
+                               rank_window=SAMPLING_RANK_WINDOW)
 
 def process_comparison(db, venue_id, user, sorted_items, new_item,
                        alpha_annealing=0.6):
@@ -146,72 +405,271 @@ def process_comparison(db, venue_id, user, sorted_items, new_item,
         to the user. If sorted_items contains only two elements then
         new_item is None.
     """
-    if sorted_items == None or len(sorted_items) <= 1:
+    return process_comparisons(db, venue_id, [sorted_items],
+                               alpha_annealing=alpha_annealing)
+
+def process_comparisons(db, venue_id, sorted_items_list, alpha_annealing=0.6):
+    """ Function updates quality distributions of submissions given a list
+    of comparisons of a venue, comparisons are processed in order.
+    Each element of sorted_items_list is like sorted_items in
+    process_comparison. Qualities of all compared submissions are read and
+    written once. In between, the result is the same as calling
+    process_comparison on each comparison: after each comparison, quality
+    distributions of its submissions are reduced to their mean and stdev.
+    Returns the number of submissions written.
+    """
+    sorted_items_list = [x for x in sorted_items_list
+                         if x is not None and len(x) > 1]
+    if len(sorted_items_list) == 0:
         return None
-    qdistr_param = get_qdistr_param(db, venue_id, sorted_items)
+    # Qualities are always read from the db, the cache is only written
+    # through, so concurrent comparisons never overwrite each other.
+    old_token = venue_cache.get_token(db, venue_id)
+    items = []
+    seen = set()
+    for sorted_items in sorted_items_list:
+        for x in sorted_items:
+            if x not in seen:
+                seen.add(x)
+                items.append(x)
+    qdistr_param = get_qdistr_param(db, venue_id, items)
     # If qdistr_param is None then some submission does not have qualities yet,
     # therefore we cannot process comparison.
     if qdistr_param == None:
         return None
-    rankobj = Rank.from_qdistr_param(sorted_items, qdistr_param,
-                                     alpha=alpha_annealing)
-    result = rankobj.update(sorted_items, new_item)
-    # Updating the DB.
-    for x in sorted_items:
-        perc, avrg, stdev = result[x]
-        # Updating submission table with its quality and error.
-        db((db.submission.id == x) &
-           (db.submission.venue_id == venue_id)).update(quality=avrg, error=stdev)
-        # Saving then latest rank update date.
-        db(db.venue.id == venue_id).update(latest_rank_update_date = datetime.utcnow())
-
-
-def evaluate_contributors(db, venue_id):
+    param_d = dict((x, qdistr_param[2 * i: 2 * i + 2])
+                   for i, x in enumerate(items))
+    result = {}
+    for sorted_items in sorted_items_list:
+        rankobj = Rank.from_qdistr_param(sorted_items,
+                                         sum([param_d[x] for x in sorted_items], []),
+                                         alpha=alpha_annealing)
+        result.update(rankobj.update(sorted_items, changed_only=True))
+        for x in sorted_items:
+            param_d[x] = list(result[x][1:])
+    # Updating submission table with qualities and errors.
+    num_rows = bulk_update(db, db.submission, venue_id, ['quality', 'error'],
+                           [(x, result[x][1], result[x][2]) for x in items])
+    # Saving then latest rank update date.
+    version = bump_rank_version(db, venue_id,
+                                latest_rank_update_date = datetime.utcnow())
+    if version == (old_token[0] or 0) + 1:
+        venue_cache.update(venue_id, old_token, (version, old_token[1]), result)
+    else:
+        # Somebody else wrote qualities since old_token was read.
+        venue_cache.invalidate(venue_id)
+    return num_rows
+
+def enqueue_comparison(db, venue_id, comparison_id):
+    """ Queues comparison comparison_id of venue venue_id, it is processed
+    later by process_comparison_queue.
+    """
+    db.comparison_queue.insert(venue_id = venue_id,
+                               comparison_id = comparison_id,
+                               date = datetime.utcnow())
+
+def process_comparison_queue(db, alpha_annealing=0.6):
+    """ Processes all queued comparisons and removes them from the queue.
+    Comparisons of a venue are processed together in the order they were
+    queued (see process_comparisons) and committed in one transaction.
+    Only one worker processes the queue at a time: a worker which cannot
+    take the lock file of the queue does nothing.
+    If processing the comparisons of a venue fails, the error is logged,
+    they are rolled back and left in the queue, and other venues are
+    processed.
+    Returns the number of processed comparisons.
+    """
+    lock_dir = os.path.join(current.request.folder, 'cache')
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir)
+    lock_file = open(os.path.join(lock_dir, 'comparison_queue.lock'), 'a')
+    try:
+        try:
+            portalocker.lock(lock_file, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        except (IOError, OSError):
+            # Another worker is processing the queue.
+            return 0
+        return process_locked_comparison_queue(db, alpha_annealing)
+    finally:
+        # Closing the file releases the lock.
+        lock_file.close()
+
+def process_locked_comparison_queue(db, alpha_annealing):
+    """ Processes the comparison queue, see process_comparison_queue. """
+    logger = logging.getLogger(current.request.application)
+    rows = db().select(db.comparison_queue.ALL, orderby=db.comparison_queue.id)
+    venue_to_rows = collections.OrderedDict()
+    for r in rows:
+        venue_to_rows.setdefault(r.venue_id, []).append(r)
+    num_processed = 0
+    for venue_id, queue_rows in venue_to_rows.iteritems():
+        try:
+            comparison_ids = [r.comparison_id for r in queue_rows]
+            comparisons = db(db.comparison.id.belongs(comparison_ids)).select(
+                db.comparison.id, db.comparison.ordering_packed)
+            orderings = comparison_log.read_orderings(db, comparisons)
+            # Orderings are stored from Best to Worst, so we reverse them.
+            sorted_items_list = [orderings[x][::-1].tolist() if orderings.has_key(x)
+                                 else [] for x in comparison_ids]
+            process_comparisons(db, venue_id, sorted_items_list,
+                                alpha_annealing=alpha_annealing)
+            db(db.comparison_queue.id.belongs([r.id for r in queue_rows])).delete()
+        except Exception:
+            db.rollback()
+            logger.exception("Queued comparisons of venue %d cannot be processed" % venue_id)
+            continue
+        db.commit()
+        num_processed += len(queue_rows)
+    return num_processed
+
+
+def get_last_comparisons(db, venue_id):
+    """ Returns a dictionary user -> ordering (int array from Best to Worst)
+    of the last valid comparison of each user of the venue.
+    Last comparisons are found by one query, as the comparisons with the
+    largest id of each user (on the Google datastore, which has no GROUP
+    BY, by reading all comparisons of the venue).
+    """
+    c = db.comparison
+    if uses_datastore(db):
+        last_rows = {}
+        for r in db(c.venue_id == venue_id).select(
+                c.id, c.user, c.ordering_packed, c.is_valid, orderby=c.id):
+            if r.is_valid is None or r.is_valid:
+                last_rows[r.user] = r
+        rows = last_rows.values()
+        orderings = comparison_log.read_orderings(db, rows)
+        return dict((r.user, orderings[r.id]) for r in rows)
+    valid = (c.venue_id == venue_id) & ((c.is_valid == True) | (c.is_valid == None))
+    last_ids = db(valid)._select(c.id.max(), groupby=c.user)
+    rows = db(c.id.belongs(last_ids)).select(c.id, c.user, c.ordering_packed)
+    orderings = comparison_log.read_orderings(db, rows)
+    return dict((r.user, orderings[r.id]) for r in rows)
+
+def evaluate_contributors(db, venue_id, progress=None):
     """This function evaluates reviewers for a venue.
     Currently, this based on last comparisons made by each reviewer.
+    Reviewers are evaluated together (see Rank.evaluate_orderings), by
+    PROGRESS_STEP at a time, and their accuracies are written in bulk.
+    progress, if it is not None, is called as progress(x) after each
+    step, where x is the fraction of reviewers evaluated.
     TODO(luca,michael): should we use all comparisons instead?"""
 
-    items, qdistr_param, _ = get_all_items_qdistr_param_and_users(db, venue_id)
-    if items == None or len(items) == 0:
+    state = venue_cache.get(db, venue_id)
+    if state.items == None or len(state.items) == 0:
         return None
     # Obtaining list of users who did comparisons.
-    comp_r = db(db.comparison.venue_id == venue_id).select(db.comparison.user)
+    comp_r = db(db.comparison.venue_id == venue_id).select(db.comparison.user,
+                                                           distinct=True)
     list_of_users = [x.user for x in comp_r]
-    list_of_users = list(set(list_of_users))
-
-    rankobj = Rank.from_qdistr_param(items, qdistr_param, cost_obj=None)
-    for user in list_of_users:
-        last_comparison = db((db.comparison.user == user)
-            & (db.comparison.venue_id == venue_id)).select(orderby=~db.comparison.date).first()
-        if last_comparison == None:
-            # Deleting the db.user_accuracy fot this venu_id and user.
-            db((db.user_accuracy.venue_id == venue_id) & (db.user_accuracy.user == user)).delete()
-            continue
-        ordering = util.get_list(last_comparison.ordering)
-        ordering = ordering[::-1]
-        val = rankobj.evaluate_ordering(ordering)
-        # Normalization
-        num_subm_r = db(db.venue.id == venue_id).select(db.venue.number_of_submissions_per_reviewer).first()
-        if num_subm_r is None or num_subm_r.number_of_submissions_per_reviewer is None:
-            # For compatability with venues which do not have the constant.
-            num_subm = 5
-        else:
-            num_subm = num_subm_r.number_of_submissions_per_reviewer
+    user_to_ordering = get_last_comparisons(db, venue_id)
+    # Normalization
+    num_subm_r = db(db.venue.id == venue_id).select(db.venue.number_of_submissions_per_reviewer).first()
+    if num_subm_r is None or num_subm_r.number_of_submissions_per_reviewer is None:
+        # For compatability with venues which do not have the constant.
+        num_subm = 5
+    else:
+        num_subm = num_subm_r.number_of_submissions_per_reviewer
+
+    rankobj = state.get_rank(keep=venue_cache.keep_qdistr)
+    users = user_to_ordering.keys()
+    orderings = [user_to_ordering[user][::-1] for user in users]
+    vals = []
+    for i in xrange(0, len(orderings), PROGRESS_STEP):
+        vals.extend(rankobj.evaluate_orderings(orderings[i:i + PROGRESS_STEP]).tolist())
+        if progress is not None:
+            progress(float(len(vals)) / len(orderings))
+    records = []
+    for user, ordering, val in zip(users, orderings, vals):
         # TODO(michael): num_subm can be zero, take care of it.
         val = min(1, val/float(num_subm))
-        # Writing to the DB.
-        db.user_accuracy.update_or_insert((db.user_accuracy.venue_id == venue_id) &
-                                          (db.user_accuracy.user == user),
-                                           venue_id = venue_id,
-                                           user = user,
-                                           accuracy = val,
-                                           reputation = None,
-                                           n_ratings = len(ordering) )
+        records.append(dict(user = user,
+                            accuracy = val,
+                            reputation = None,
+                            n_ratings = len(ordering)))
+    # Writing to the DB, after the last progress report which commits.
+    # Deleting the db.user_accuracy for users without valid comparisons.
+    no_comparison_users = [u for u in list_of_users if u not in user_to_ordering]
+    if len(no_comparison_users) > 0:
+        db((db.user_accuracy.venue_id == venue_id) &
+           (db.user_accuracy.user.belongs(no_comparison_users))).delete()
+    bulk_update_or_insert_by_user(db, db.user_accuracy, venue_id, records)
     # Saving the latest user evaluation date.
     db(db.venue.id == venue_id).update(latest_reviewers_evaluation_date = datetime.utcnow())
 
 
-def rerun_processing_comparisons(db, venue_id, alpha_annealing=0.5, run_twice=False):
+def iter_comparisons(db, venue_id, descending=False,
+                     page_size=COMPARISON_PAGE_SIZE):
+    """ Yields a tuple (comparison_id, user, sorted_items, new_item) for each valid
+    comparison of the venue, in order of date (most recent first if
+    descending is True).
+    sorted_items is an int array of submission ids, from worst to best;
+    comparisons of less than two submissions are skipped.
+    Only the fields needed to replay comparisons are read, page_size rows
+    at a time, so the memory used does not grow with the number of
+    comparisons of the venue. Pages are delimited by (date, id) of the
+    last row read rather than by offset, so each page query can use the
+    index on date instead of skipping over all the previous rows.
+    """
+    c = db.comparison
+    fields = [c.id, c.user, c.ordering_packed, c.new_item, c.is_valid, c.date]
+    if descending:
+        orderby = ~c.date | ~c.id
+    else:
+        orderby = c.date | c.id
+    last = None
+    while True:
+        query = (c.venue_id == venue_id)
+        if last is not None:
+            last_date, last_id = last
+            if descending:
+                query &= ((c.date < last_date) |
+                          ((c.date == last_date) & (c.id < last_id)))
+            else:
+                query &= ((c.date > last_date) |
+                          ((c.date == last_date) & (c.id > last_id)))
+        rows = db(query).select(*fields, orderby=orderby,
+                                limitby=(0, page_size))
+        orderings = comparison_log.read_orderings(db, rows)
+        for r in rows:
+            # Check if comparison is valid.
+            if r.is_valid is not None and not r.is_valid:
+                continue
+            # Reverses the ordering.
+            ordering = orderings[r.id]
+            if len(ordering) < 2:
+                continue
+            yield r.id, r.user, ordering[::-1], r.new_item
+        if len(rows) < page_size:
+            return
+        last = (rows[-1].date, rows[-1].id)
+
+
+def get_comparisons(db, venue_id, descending=False):
+    """ Returns an iterator over the valid comparisons of the venue, like
+    iter_comparisons. If USE_COMPARISON_LOG is set, the comparison log of
+    the venue is brought up to date and replayed; comparisons are then in
+    the order they were inserted rather than in order of date.
+    If the log cannot be written, comparisons are read from the db.
+    """
+    if USE_COMPARISON_LOG:
+        try:
+            log = comparison_log.update_log(db, venue_id)
+        except (IOError, OSError):
+            log = None
+        if log is not None:
+            return log.replay(comparison_log.get_invalid_ids(db, venue_id),
+                              descending=descending)
+    return iter_comparisons(db, venue_id, descending=descending)
+
+
+def rerun_processing_comparisons(db, venue_id, alpha_annealing=0.5, run_twice=False,
+                                 progress=None):
+    """ Recomputes qualities of submissions from scratch with all the
+    comparisons of the venue.
+    progress, if it is not None, is called as progress(x) after every
+    PROGRESS_STEP comparisons, where x is the fraction of comparisons done.
+    """
 
     # We reset the ranking to the initial values.
     # Gets a ranker object to do the ranking, initialized with all the submissions with
@@ -226,39 +684,27 @@ def rerun_processing_comparisons(db, venue_id, alpha_annealing=0.5, run_twice=Fa
     rankobj = Rank.from_qdistr_param(items, qdistr_param, alpha=alpha_annealing)
 
     # Processes the list of comparisons.
-    result = None
-    comparison_list = db(db.comparison.venue_id == venue_id).select(orderby=db.comparison.date)
-    for comp in comparison_list:
-	# Processes the comparison, if valid.
-	if comp.is_valid is None or comp.is_valid == True:
-	    # Reverses the list.
-	    sorted_items = util.get_list(comp.ordering)[::-1]
-	    if len(sorted_items) < 2:
-		continue
-	    result = rankobj.update(sorted_items, new_item=comp.new_item)
+    orderings = [sorted_items for _, _, sorted_items, _ in
+                 get_comparisons(db, venue_id)]
     if run_twice:
-	comparison_list = db(db.comparison.venue_id == venue_id).select(orderby=~db.comparison.date)
-	for comp in comparison_list:
-	    # Processes the comparison, if valid.
-	    if comp.is_valid is None or comp.is_valid == True:
-		# Reverses the list.
-		sorted_items = util.get_list(comp.ordering)[::-1]
-		if len(sorted_items) < 2:
-		    continue
-		result = rankobj.update(sorted_items, new_item=comp.new_item)
-
-    # Writes the updated statistics to the db.  Note that result contains the result for
-    # all the ids, due to how the rankobj has been initialized.
-    if result is None:
+        orderings.extend(sorted_items for _, _, sorted_items, _ in
+                         get_comparisons(db, venue_id, descending=True))
+
+    if len(orderings) == 0:
         return
-    for x in items:
-        perc, avrg, stdev = result[x]
-        db((db.submission.id == x) &
-           (db.submission.venue_id == venue_id)).update(quality=avrg, error=stdev, percentile=perc)
+    for i in xrange(0, len(orderings), PROGRESS_STEP):
+        rankobj.update_batch(orderings[i:i + PROGRESS_STEP])
+        if progress is not None:
+            progress(float(min(i + PROGRESS_STEP, len(orderings))) / len(orderings))
+
+    # Writes the updated statistics to the db.
+    result = rankobj.get_result()
+    bulk_update(db, db.submission, venue_id, ['quality', 'error', 'percentile'],
+                [(x, result[x][1], result[x][2], result[x][0]) for x in items])
     # Saving the latest rank update date.
     description = "Ranking without reputation system. All comparisons are used in chronological order"
-    db(db.venue.id == venue_id).update(latest_rank_update_date = datetime.utcnow(),
-                                    ranking_algo_description = description)
+    bump_rank_version(db, venue_id, latest_rank_update_date = datetime.utcnow(),
+                      ranking_algo_description = description)
 
 
 def get_or_0(d, k):
@@ -278,8 +724,11 @@ def rank_without_rep_sys(db, venue_id, alpha_annealing=0.5):
     run_reputation_system(db, venue_id, alpha_annealing=0.5,
                           num_of_iterations=1, last_compar_param=None)
 
-def compute_final_grades(db, venue_id):
-    """This function computes the final grades.  We assume that every user has only one submission."""
+def compute_final_grades(db, venue_id, progress=None, commit=True):
+    """This function computes the final grades.  We assume that every user has only one submission.
+    progress, if it is not None, is called as progress(x) before the grades
+    are written. If commit is False, the grades are written but not
+    committed (see jobs.run_job)."""
     # Let us read and sort all submission grades.
     list_of_users = []
     user_to_subm_grade = {}
@@ -309,6 +758,8 @@ def compute_final_grades(db, venue_id):
     n_users = float(len(sorted_l))
     for i, el in enumerate(sorted_l):
 	percentile[el[0]] = 100.0 * (n_users - float(i)) / n_users
+    if progress is not None:
+        progress(0.5)
     # Writes the final grades to the DB.
     db(db.grades.venue_id == venue_id).delete()
     for u in list_of_users:
@@ -319,7 +770,8 @@ def compute_final_grades(db, venue_id):
 			 )
     # Saving the latest date when final grades were evaluated.
     db(db.venue.id == venue_id).update(latest_final_grades_evaluation_date = datetime.utcnow())
-    db.commit()
+    if commit:
+        db.commit()
 
 def compute_final_grades_helper(list_of_users, user_to_subm_grade,
                                 user_to_rev_grade):
@@ -353,24 +805,23 @@ def read_db_for_rep_sys(db, venue_id, last_compar_param):
     subm_d = {}
     ordering_l = []
     ordering_d = {}
+    # Ids of the comparisons in ordering_l.
+    id_l = []
+    last_id_d = {}
     # Reading submission table.
-    rows = db(db.submission.venue_id == venue_id).select()
+    rows = db(db.submission.venue_id == venue_id).select(db.submission.id,
+                                                         db.submission.user)
     for r in rows:
         subm_l.append(r.id)
         subm_d[r.user] = r.id
         user_l.append(r.user)
     # Reading comparisons table.
-    rows = db(db.comparison.venue_id == venue_id).select(orderby=db.comparison.date)
-    for r in rows:
-        # Check if comparison is valid.
-        if r.is_valid is None or r.is_valid == True:
-            # Reverses the ordering.
-            sorted_items = util.get_list(r.ordering)[::-1]
-            if len(sorted_items) < 2:
-                continue
-            ordering_d[r.user] = sorted_items
-            # Initializing reviewers reputation and accuracy.
-            ordering_l.append((sorted_items, r.user))
+    for comparison_id, user, sorted_items, _ in get_comparisons(db, venue_id):
+        ordering_d[user] = sorted_items
+        last_id_d[user] = comparison_id
+        # Initializing reviewers reputation and accuracy.
+        ordering_l.append((sorted_items, user))
+        id_l.append(comparison_id)
     # Adding reviewers to user_l.
     for user in ordering_d.iterkeys():
         if user not in user_l:
@@ -378,48 +829,268 @@ def read_db_for_rep_sys(db, venue_id, last_compar_param):
     # If we want to use only last comparisons.
     if not last_compar_param is None:
         ordering_l = [(ordering, user) for user, ordering in ordering_d.iteritems()]
-    return user_l, subm_l, ordering_l, subm_d, ordering_d
+        id_l = [last_id_d[user] for ordering, user in ordering_l]
+    return user_l, subm_l, ordering_l, subm_d, ordering_d, id_l
 
 def write_to_db_for_rep_sys(db, venue_id, rankobj_result, subm_l, user_l,
                             ordering_d, accuracy_d, rep_d, perc_final_d,
-                            final_grade_d, ranking_algo_description):
-    # Writting to submission table.
-    for x in subm_l:
-        perc, avrg, stdev = rankobj_result[x]
-        db((db.submission.id == x) &
-           (db.submission.venue_id == venue_id)).update(quality=avrg, error=stdev, percentile=perc)
-    # Writting to user accuracy table.
-    for user in accuracy_d:
-        if ordering_d.has_key(user):
-            n_ratings = len(ordering_d[user])
-        else:
-            n_ratings = 0
-        db.user_accuracy.update_or_insert((db.user_accuracy.venue_id == venue_id) &
-                                  (db.user_accuracy.user == user),
-                                   venue_id = venue_id,
-                                   user = user,
+                            final_grade_d, ranking_algo_description, commit=True):
+    """ Writes results of the reputation system to the db in one transaction,
+    rows of each table are written in bulk. If commit is False, the
+    transaction is left to the caller to commit.
+    Returns the number of rows written.
+    """
+    try:
+        # Writting to submission table.
+        num_rows = bulk_update(db, db.submission, venue_id,
+            ['quality', 'error', 'percentile'],
+            [(x, rankobj_result[x][1], rankobj_result[x][2], rankobj_result[x][0])
+             for x in subm_l])
+        # Writting to user accuracy table.
+        accuracy_l = []
+        for user in accuracy_d:
+            if ordering_d.has_key(user):
+                n_ratings = len(ordering_d[user])
+            else:
+                n_ratings = 0
+            accuracy_l.append(dict(user = user,
                                    accuracy = accuracy_d[user],
                                    reputation = rep_d[user],
-                                   n_ratings = n_ratings )
-    # Updating final grades.
-    db(db.grades.venue_id == venue_id).delete()
-    for u in user_l:
-	db.grades.insert(venue_id = venue_id,
-			 user = u,
-			 grade = final_grade_d[u],
-			 percentile = perc_final_d[u]
-			 )
-    # Saving evaluation date.
-    t = datetime.utcnow()
-    # TODO(michael): think about of substituting these fields by one field.
-    db(db.venue.id == venue_id).update(latest_reviewers_evaluation_date = t,
-                                       latest_rank_update_date = t,
-                                       latest_final_grades_evaluation_date = t,
-                                       ranking_algo_description = ranking_algo_description)
-    db.commit()
+                                   n_ratings = n_ratings))
+        num_rows += bulk_update_or_insert_by_user(db, db.user_accuracy,
+                                                  venue_id, accuracy_l)
+        # Updating final grades.
+        db(db.grades.venue_id == venue_id).delete()
+        db.grades.bulk_insert([dict(venue_id = venue_id,
+                                    user = u,
+                                    grade = final_grade_d[u],
+                                    percentile = perc_final_d[u]) for u in user_l])
+        num_rows += len(user_l)
+        # Saving evaluation date.
+        t = datetime.utcnow()
+        # TODO(michael): think about of substituting these fields by one field.
+        bump_rank_version(db, venue_id, latest_reviewers_evaluation_date = t,
+                          latest_rank_update_date = t,
+                          latest_final_grades_evaluation_date = t,
+                          ranking_algo_description = ranking_algo_description)
+    except:
+        db.rollback()
+        raise
+    if commit:
+        db.commit()
+    return num_rows + 1
+
+def get_rep_sys_checkpoint_path(venue_id):
+    return os.path.join(current.request.folder, 'cache', 'rep_sys',
+                        'venue_%d.npz' % venue_id)
+
+def save_rep_sys_checkpoint(venue_id, params, rankobj, rep_d, accuracy_d,
+                            ordering_d, last_id, invalid_ids, chain_spread=None):
+    """ Saves the state of the reputation system after a run on the
+    comparisons with id up to last_id, so that the next run can resume from
+    it (see run_reputation_system). chain_spread is the spread across
+    chains of the run, if it used chains.
+    """
+    path = get_rep_sys_checkpoint_path(venue_id)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    users = rep_d.keys()
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        np.savez(f, params=np.array(repr(params)),
+                 items=np.array(rankobj.orig_items_id),
+                 qdistr=rankobj.qdistr,
+                 users=np.array(users),
+                 reputations=np.array([rep_d[u] for u in users]),
+                 accuracies=np.array([accuracy_d[u] for u in users]),
+                 reviewers=np.array(ordering_d.keys()),
+                 last_id=np.array(last_id),
+                 invalid_ids=np.array([x for x in invalid_ids if x <= last_id]),
+                 chain_spread=np.array(chain_spread or []))
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def load_rep_sys_checkpoint(venue_id):
+    """ Returns the state saved by save_rep_sys_checkpoint as a dictionary,
+    or None if there is no checkpoint for the venue.
+    """
+    path = get_rep_sys_checkpoint_path(venue_id)
+    if not os.path.exists(path):
+        return None
+    f = np.load(path)
+    try:
+        users = f['users'].tolist()
+        chain_spread = None
+        if 'chain_spread' in f.files and len(f['chain_spread']) > 0:
+            chain_spread = tuple(f['chain_spread'].tolist())
+        return dict(params = str(f['params']),
+                    items = f['items'].tolist(),
+                    qdistr = f['qdistr'],
+                    rep_d = dict(zip(users, f['reputations'].tolist())),
+                    accuracy_d = dict(zip(users, f['accuracies'].tolist())),
+                    reviewers = set(f['reviewers'].tolist()),
+                    last_id = int(f['last_id']),
+                    invalid_ids = set(f['invalid_ids'].tolist()),
+                    chain_spread = chain_spread)
+    finally:
+        f.close()
+
+def can_resume_rep_sys(state, params, subm_l, ordering_l, id_l, invalid_ids,
+                       last_compar_param):
+    """ Returns True if the reputation system can resume from the saved
+    state, which is the case if parameters and submissions are the same
+    and the comparisons used by the saved run are still valid. In the
+    "small alpha" mode, the last comparison of reviewers used by the saved
+    run also has to be the same.
+    """
+    if state['params'] != repr(params):
+        return False
+    if sorted(state['items']) != sorted(subm_l):
+        return False
+    last_id = state['last_id']
+    if set(x for x in invalid_ids if x <= last_id) != state['invalid_ids']:
+        return False
+    if last_compar_param is not None:
+        for (ordering, user), comparison_id in zip(ordering_l, id_l):
+            if comparison_id > last_id and user in state['reviewers']:
+                return False
+    return True
+
+def get_rep_sys_orderings(ordering_l, rep_d, last_compar_param, rng=random):
+    """ Returns lists orderings, alphas of the comparisons in ordering_l
+    processed in one iteration of the reputation system, and the annealing
+    coefficients they are processed with.
+    rng is used to shuffle the comparisons in the "small alpha" mode.
+    """
+    orderings, alphas = [], []
+    if last_compar_param is None:
+        # Using all comparisons in chronological order.
+        for ordering, user in ordering_l:
+            orderings.append(ordering)
+            alphas.append(rep_d[user])
+    else:
+        # Using only last comparisons and iterating many times with small alpha.
+        for i in xrange(last_compar_param):
+            # Genarating random permutation.
+            idxs = range(len(ordering_l))
+            rng.shuffle(idxs)
+            for idx in idxs:
+                ordering, user = ordering_l[idx]
+                alpha = rep_d[user]
+                alpha = 1 - (1 - alpha) ** (1.0/(4*last_compar_param))
+                #alpha = alpha / float(2*last_compar_param)
+                orderings.append(ordering)
+                alphas.append(alpha)
+    return orderings, alphas
+
+def run_rep_sys_chain(args):
+    """ Runs one chain of an iteration of the "small alpha" reputation
+    system: starting from distributions qdistr (or, if it is None, from
+    distributions with parameters qdistr_param), processes the last
+    comparisons shuffled with random seed seed.
+    args is a tuple (items, qdistr_param, qdistr, alpha_annealing,
+    ordering_l, rep_d, last_compar_param, seed), so the function can be
+    mapped over worker processes (see RepSysChains).
+    Returns the quality distributions of items.
+    """
+    (items, qdistr_param, qdistr, alpha_annealing, ordering_l, rep_d,
+     last_compar_param, seed) = args
+    if qdistr is None:
+        rankobj = Rank.from_qdistr_param(items, qdistr_param, alpha=alpha_annealing)
+    else:
+        rankobj = Rank.from_qdistr(items, qdistr, alpha=alpha_annealing)
+    orderings, alphas = get_rep_sys_orderings(ordering_l, rep_d,
+                                              last_compar_param,
+                                              rng=random.Random(seed))
+    rankobj.update_batch(orderings, alphas)
+    return rankobj.qdistr
+
+
+class RepSysChains(object):
+    """ Runs num_chains independent chains of the "small alpha" reputation
+    system (see run_rep_sys_chain) in a pool of worker processes, which is
+    created on the first run and used by all the iterations of a run.
+    A process which cannot have children (a worker of
+    jobs.run_jobs_in_pool) runs the chains itself.
+    Chains are seeded from seed, venue_id, the step of the run and the
+    index of the chain, so runs are reproducible.
+    """
+    def __init__(self, num_chains, venue_id, seed=0):
+        self.num_chains = num_chains
+        self.venue_id = venue_id
+        self.seed = seed
+        self.pool = None
+
+    def get_seed(self, step, k):
+        return ((self.seed * 1000003 + self.venue_id) * 1009 + step) * 1009 + k
+
+    def run(self, step, items, alpha_annealing, ordering_l, rep_d,
+            last_compar_param, qdistr_param=None, qdistr=None):
+        """ Runs the chains of step step, starting from distributions qdistr
+        or from parameters qdistr_param (see run_rep_sys_chain).
+        Returns a tuple (qdistr, spread) where qdistr are the distributions
+        of items averaged over the chains, and spread is like in
+        get_chain_spread.
+        """
+        # Orderings are copied, so they can be sent to other processes.
+        ordering_l = [(np.array(ordering), user) for ordering, user in ordering_l]
+        tasks = [(items, qdistr_param, qdistr, alpha_annealing, ordering_l,
+                  rep_d, last_compar_param, self.get_seed(step, k))
+                 for k in xrange(self.num_chains)]
+        if (self.pool is None and self.num_chains > 1 and
+            not multiprocessing.current_process().daemon):
+            self.pool = multiprocessing.Pool(min(self.num_chains,
+                                                 multiprocessing.cpu_count()))
+        if self.pool is None:
+            qdistrs = map(run_rep_sys_chain, tasks)
+        else:
+            qdistrs = self.pool.map(run_rep_sys_chain, tasks, chunksize=1)
+        return np.mean(qdistrs, 0), get_chain_spread(items, qdistrs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def get_chain_spread(subm_l, qdistrs):
+    """ Returns the average and the maximum over submissions of the
+    standard deviation across chains of the percentile of a submission,
+    where qdistrs[k] are the distributions of submissions subm_l obtained
+    by chain k.
+    """
+    percs = []
+    for qdistr in qdistrs:
+        result = Rank.from_qdistr(subm_l, qdistr).get_result()
+        percs.append([result[x][0] for x in subm_l])
+    stdev = np.std(np.array(percs), 0)
+    return np.mean(stdev), np.max(stdev)
+
+def update_reputations(rankobj, result, subm_d, ordering_d, rep_d, accuracy_d):
+    """ Updates accuracy and reputation of users in rep_d given the ranking
+    of rankobj and its result. """
+    # Accuracies of all reviewers are computed together.
+    reviewers = [user for user in rep_d if ordering_d.has_key(user)]
+    accuracies = rankobj.evaluate_orderings_using_dirichlet(
+        [ordering_d[user] for user in reviewers])
+    reviewer_accuracy_d = dict(zip(reviewers, accuracies.tolist()))
+    for user in rep_d:
+        if subm_d.has_key(user):
+            perc, avrg, stdev = result[subm_d[user]]
+            rank = perc / 100.0
+        else:
+            rank = 0.5 # TODO(michael): Should we trust unknown reviewer?
+        accuracy = reviewer_accuracy_d.get(user, 0)
+        accuracy_d[user] = accuracy
+        # Computer user's reputation.
+        rep_d[user] = (rank * accuracy) ** 0.5
 
 def run_reputation_system(db, venue_id, alpha_annealing=0.5,
-                          num_of_iterations=4, last_compar_param=10):
+                          num_of_iterations=4, last_compar_param=10,
+                          progress=None, checkpoint=False, tolerance=None,
+                          num_chains=None, seed=0, commit=True):
     """ Function calculates submission qualities, user's reputation, reviewer's
     quality and final grades.
     Arguments:
@@ -427,10 +1098,38 @@ def run_reputation_system(db, venue_id, alpha_annealing=0.5,
         If the argument is None then we update using all comparisons one time in chronological order.
         Otherwise we use "small alpha" approach, where last_compar_param is
         number of iterations.
+        - progress, if it is not None, is called as progress(x) after each
+        iteration, where x is the fraction of iterations done.
+        - checkpoint, if True, the state of the reputation system is saved
+        after the run, and if a state saved by a run with the same
+        parameters can be resumed (see can_resume_rep_sys), only the
+        comparisons made since that run are processed, in one iteration,
+        starting from the saved rankings and reputations. Otherwise all
+        the iterations are run from scratch.
+        - tolerance, if it is not None, iterations stop as soon as the
+        average change of reputations and the average change of submission
+        percentiles (as a fraction) in an iteration are both at most
+        tolerance; num_of_iterations is then the maximum number of
+        iterations.
+        - num_chains, if it is not None and last_compar_param is not None,
+        each iteration runs num_chains independent chains of shuffled
+        comparisons in parallel processes, and averages their distributions
+        (see RepSysChains). A resumed run processes the new comparisons with
+        chains as well. Chains are seeded from seed, so runs are
+        reproducible. The spread of percentiles across chains is recorded in
+        the description of the ranking.
+        - commit, if False, results are written but not committed and the
+        checkpoint is not saved; the function then returns a function which
+        saves the checkpoint, to be called once results are committed
+        (see jobs.run_job).
     """
+    if checkpoint:
+        # Invalidated comparisons are read first: a comparison invalidated
+        # while the run is in progress makes the next run start from scratch.
+        invalid_ids = comparison_log.get_invalid_ids(db, venue_id)
     # Reading the DB to get submission and user information.
     # Lists have l suffix, dictionaries user -> val have d suffix.
-    user_l, subm_l, ordering_l, subm_d, ordering_d = read_db_for_rep_sys(db, venue_id, last_compar_param)
+    user_l, subm_l, ordering_l, subm_d, ordering_d, id_l = read_db_for_rep_sys(db, venue_id, last_compar_param)
     # Initializing the rest of containers.
     qdistr_param_default = []
     for subm in subm_l:
@@ -439,49 +1138,104 @@ def run_reputation_system(db, venue_id, alpha_annealing=0.5,
     rep_d = {user: alpha_annealing for user in user_l}
     accuracy_d = {user: 0 for user in user_l}
 
-    # Okay, now we are ready to run main iterations.
-    result = None
-    for it in xrange(num_of_iterations):
-        # In the beginning of iteration initialize rankobj with default
-        # submissions qualities.
-        rankobj = Rank.from_qdistr_param(subm_l, qdistr_param_default,
-                                         alpha=alpha_annealing)
-        # Okay, now we update quality distributions with comparisons
-        # using reputation of users as annealing coefficient.
-        if last_compar_param is None:
-            # Using all comparisons in chronological order.
-            for ordering, user in ordering_l:
-                alpha = rep_d[user]
-                result = rankobj.update(ordering, alpha_annealing=alpha)
-        else:
-            # Using only last comparisons and iterating many times with small alpha.
-            for i in xrange(last_compar_param):
-                # Genarating random permutation.
-                idxs = range(len(ordering_l))
-                random.shuffle(idxs)
-                for idx in idxs:
-                    ordering, user = ordering_l[idx]
-                    alpha = rep_d[user]
-                    alpha = 1 - (1 - alpha) ** (1.0/(4*last_compar_param))
-                    #alpha = alpha / float(2*last_compar_param)
-                    result = rankobj.update(ordering, alpha_annealing=alpha)
-        if result is None:
-            return
-        # Computing reputation.
-        for user in rep_d:
-            if subm_d.has_key(user):
-                perc, avrg, stdev = result[subm_d[user]]
-                rank = perc / 100.0
+    params = (alpha_annealing, num_of_iterations, last_compar_param, tolerance,
+              num_chains, seed)
+    convergence = None
+    chain_spread = None
+    state = None
+    if checkpoint:
+        state = load_rep_sys_checkpoint(venue_id)
+        if state is not None and not can_resume_rep_sys(
+                state, params, subm_l, ordering_l, id_l, invalid_ids,
+                last_compar_param):
+            state = None
+    chains = None
+    if num_chains is not None and last_compar_param is not None:
+        chains = RepSysChains(num_chains, venue_id, seed)
+    try:
+        if state is not None:
+            # Resuming from the saved state with the comparisons made since.
+            rankobj = Rank.from_qdistr(state['items'], state['qdistr'],
+                                       alpha=alpha_annealing)
+            for user in user_l:
+                if state['rep_d'].has_key(user):
+                    rep_d[user] = state['rep_d'][user]
+                    accuracy_d[user] = state['accuracy_d'][user]
+            new_ordering_l = [x for x, comparison_id in zip(ordering_l, id_l)
+                              if comparison_id > state['last_id']]
+            chain_spread = state['chain_spread']
+            if chains is not None:
+                is_updated = len(new_ordering_l) > 0 and last_compar_param > 0
+                if is_updated:
+                    # The step of the chains is the last comparison of the
+                    # saved run, which is different for each resumed run.
+                    qdistr, chain_spread = chains.run(
+                        state['last_id'], state['items'], alpha_annealing,
+                        new_ordering_l, rep_d, last_compar_param,
+                        qdistr=rankobj.qdistr)
+                    rankobj = Rank.from_qdistr(state['items'], qdistr,
+                                               alpha=alpha_annealing)
             else:
-                rank = 0.5 # TODO(michael): Should we trust unknown reviewer?
-            if ordering_d.has_key(user):
-                ordering = ordering_d[user]
-                accuracy = rankobj.evaluate_ordering_using_dirichlet(ordering)
-            else:
-                accuracy = 0
-            accuracy_d[user] = accuracy
-            # Computer user's reputation.
-            rep_d[user] = (rank * accuracy) ** 0.5
+                orderings, alphas = get_rep_sys_orderings(new_ordering_l, rep_d,
+                                                          last_compar_param)
+                is_updated = len(orderings) > 0
+                if is_updated:
+                    rankobj.update_batch(orderings, alphas)
+            result = rankobj.get_result()
+            if is_updated:
+                update_reputations(rankobj, result, subm_d, ordering_d, rep_d,
+                                   accuracy_d)
+            if progress is not None:
+                progress(1.0)
+        else:
+            # Okay, now we are ready to run main iterations.
+            result = None
+            for it in xrange(num_of_iterations):
+                # Okay, now we update quality distributions with comparisons
+                # using reputation of users as annealing coefficient.
+                if chains is not None:
+                    if len(ordering_l) == 0 or last_compar_param == 0:
+                        return
+                    # Chains start from default submissions qualities.
+                    qdistr, chain_spread = chains.run(
+                        it, subm_l, alpha_annealing, ordering_l, rep_d,
+                        last_compar_param, qdistr_param=qdistr_param_default)
+                    rankobj = Rank.from_qdistr(subm_l, qdistr,
+                                               alpha=alpha_annealing)
+                else:
+                    # In the beginning of iteration initialize rankobj with default
+                    # submissions qualities.
+                    rankobj = Rank.from_qdistr_param(subm_l, qdistr_param_default,
+                                                     alpha=alpha_annealing)
+                    orderings, alphas = get_rep_sys_orderings(ordering_l, rep_d,
+                                                              last_compar_param)
+                    if len(orderings) == 0:
+                        return
+                    # Comparisons which do not share submissions are processed together.
+                    rankobj.update_batch(orderings, alphas)
+                result = rankobj.get_result()
+                # Computing reputation.
+                old_rep_d = dict(rep_d)
+                update_reputations(rankobj, result, subm_d, ordering_d, rep_d,
+                                   accuracy_d)
+                if progress is not None:
+                    progress(float(it + 1) / num_of_iterations)
+                if tolerance is not None and it > 0:
+                    # Average changes, a few submissions swapping ranks should
+                    # not keep the iterations going.
+                    rep_change = np.mean([abs(rep_d[u] - old_rep_d[u])
+                                          for u in rep_d] or [0])
+                    perc_change = np.mean([abs(result[x][0] - old_result[x][0]) / 100.0
+                                           for x in subm_l] or [0])
+                    convergence = (it + 1, rep_change, perc_change)
+                    if rep_change <= tolerance and perc_change <= tolerance:
+                        if progress is not None:
+                            progress(1.0)
+                        break
+                old_result = result
+    finally:
+        if chains is not None:
+            chains.close()
 
     # Computing submission grades.
     subm_grade_d = {}
@@ -498,7 +1252,25 @@ def run_reputation_system(db, venue_id, alpha_annealing=0.5,
         description = "Reputation system with small alpha and only last comparisons"
         if num_of_iterations == 1:
             description = "No reputation system and small alpha !?!?"
+    if chain_spread is not None:
+        description += (" (%d chains, stdev of percentiles across chains %.2f on average, %.2f at most)"
+                        % ((num_chains,) + chain_spread))
+    if convergence is not None:
+        description += (" (%d iterations, last average change of reputations %.4f, of percentiles %.4f)"
+                        % convergence)
     # Writing to the BD.
     write_to_db_for_rep_sys(db, venue_id, result, subm_l, user_l, ordering_d,
                             accuracy_d, rep_d, perc_final_d, final_grade_d,
-                            ranking_algo_description=description)
+                            ranking_algo_description=description,
+                            commit=commit)
+    if checkpoint:
+        last_id = max(id_l) if len(id_l) > 0 else 0
+        if state is not None:
+            last_id = max(last_id, state['last_id'])
+        def save_checkpoint():
+            save_rep_sys_checkpoint(venue_id, params, rankobj, rep_d, accuracy_d,
+                                    ordering_d, last_id, invalid_ids,
+                                    chain_spread=chain_spread)
+        if not commit:
+            return save_checkpoint
+        save_checkpoint()